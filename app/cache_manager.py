@@ -6,20 +6,218 @@ photo dates (filename → EXIF → mtime), and pruning the cached JPEGs
 under `instance/cache/photos/` while preserving same-day entries.
 """
 
+import contextlib
 import datetime
+import functools
 import hashlib
-import heapq
+import itertools
 import json
+import mmap
 import os
 import random
 import re
 import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import session
-from PIL import ExifTags, Image, UnidentifiedImageError
+from PIL import Image, UnidentifiedImageError
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock(), so the list lock is per-process only
+    fcntl = None
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
 
 from . import globals as G
 
+# Photo file extensions recognised during scans (lower-case, with dot).
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic"})
+
+# Directories skipped during scans when their name contains any of these.
+IGNORED_DIR_MARKERS = ("thumbnails", "cache", ".git", "__pycache__", "@__thumb")
+
+# Line-offset index: a header holding the inode of the text file the offsets
+# were written for, then one little-endian uint64 byte offset per line
+# (_write_line_file() packs them in a single "<NQ" struct call). The text
+# file and its index are renamed into place separately, so readers check the
+# header to never pair a new text file with an old index, or vice versa.
+_INDEX_HEADER = struct.Struct("<Q")
+_INDEX_ENTRY = struct.Struct("<Q")
+
+# Retries (and delay in seconds) when a text file and its index don't match,
+# which lasts only between the two renames of a rebuild in another thread or
+# worker. A pair still mismatched after that is treated as missing.
+_LINE_PAIR_RETRIES = 3
+_LINE_PAIR_RETRY_DELAY = 0.01
+
+# Rows buffered before each executemany() into the photo date cache.
+_DATE_CACHE_BATCH = 1000
+
+# Seconds a connection waits for another process (e.g. a second gunicorn
+# worker building at the same time) to release the date cache's write lock.
+_DATE_CACHE_TIMEOUT = 30.0
+
+# Threads used by build_cache() to read photo dates; the work is I/O-bound.
+_BUILD_CACHE_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+
+# Ordinal suffixes for format_date_with_suffix(); 11th-13th are special-cased.
+_ORDINAL_SUFFIXES = {1: "st", 2: "nd", 3: "rd"}
+
+# Filename date pattern: YYYYMMDD or YYYY-MM-DD (the separators must match).
+_RE_FILENAME_DATE = re.compile(
+    r"(?P<y>\d{4})(?P<sep>-?)(?P<m>\d{2})(?P=sep)(?P<d>\d{2})"
+)
+
+# In-memory LRU of cached JPEGs (path -> last use time), oldest first.
+# Loaded from `dir` on first use and kept current by touch_cache_entry().
+_CACHE_LRU: dict = {"dir": None, "entries": OrderedDict()}
+
+# Cache misses don't prune inline: once the cache has grown `_PRUNE_BATCH`
+# entries past the limit, schedule_prune() hands one prune_cache() to a single
+# background worker, so the orphaned-metadata scan runs once per batch.
+_PRUNE_BATCH = 16
+_PRUNE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-prune")
+_PRUNE_STATE: dict = {"scheduled": False}
+_PRUNE_LOCK = threading.Lock()
+
+# Extensions read through pillow_heif's container parser for EXIF dates.
+# pillow_heif (and libheif) is only imported once such a file is seen.
+_HEIF_EXTENSIONS = frozenset({".heic", ".heif"})
+_HEIF_STATE: dict = {"opener_registered": False}
+_HEIF_LOCK = threading.Lock()
+
+# EXIF tag ids: ExifIFD pointer, DateTimeOriginal, DateTimeDigitized, DateTime.
+_EXIF_IFD_POINTER = 0x8769
+_EXIF_DATE_TAGS = (0x9003, 0x9004, 0x0132)
+
+# In-process memo of sidecar metadata: cache file -> (width, height, mime).
+# Cache files are written once and only change by being pruned, so entries
+# stay valid until forget_image_metadata() drops them.
+_METADATA_MEMO: dict[str, tuple] = {}
+_METADATA_MEMO_MAX = 4096
+
+# Reusable mmaps of the cache text files: idx path -> (signature, maps).
+_LINE_MAPS: dict[str, tuple] = {}
+
+# Background daily rebuild thread for this process (see start_daily_rebuild()).
+_REBUILD_STATE: dict = {"thread": None}
+_REBUILD_DELAY_SECONDS = 5
+
+# Filesystem watcher for this process (see start_photo_watcher()). Deleted
+# photos are tombstoned in "deleted" and new ones kept in "added" (path ->
+# date) until a rebuild has written them into the lists, so events that
+# arrive while a rebuild runs are not lost. "listed" mirrors each list file's
+# paths so appends dedupe without reading the file back. Guarded by
+# _LINE_FILE_LOCK.
+_WATCH_STATE: dict = {
+    "observer": None,
+    "deleted": set(),
+    "added": {},
+    "listed": {},
+}
+_LINE_FILE_LOCK = threading.Lock()
+
+# flock()ed beside the cache files so every worker's watcher and rebuild
+# writes the cache lists one at a time (see _line_files_locked()).
+_LINE_FILES_LOCK_NAME = "cache_lists.lock"
+
+# With the watcher running, scheduled rebuilds re-partition the listed paths;
+# every this many passes they walk the tree anyway, to pick up any event the
+# watcher missed.
+_WATCHED_REWALK_PASSES = 7
+
+# Random draws pick_file() retries when it lands on a tombstoned photo.
+_TOMBSTONE_RETRIES = 8
+
+# --- Cache keys ---
+
+
+def cache_key(path):
+    """Return the filename-safe cache key for photo `path`.
+
+    Uses xxh3-64 when `xxhash` is installed and MD5 otherwise; the key only
+    names cache files, so no cryptographic strength is needed.
+    """
+    data = os.fsencode(path)
+    if xxhash is not None:
+        return xxhash.xxh3_64_hexdigest(data)
+    return hashlib.md5(data).hexdigest()
+
+
+def legacy_cache_key(path):
+    """Return the MD5 key that named cached JPEGs before `cache_key()`."""
+    return hashlib.md5(os.fsencode(path)).hexdigest()
+
+
+def adopt_legacy_cache_file(path, cache_file):
+    """Rename a cached JPEG stored under `legacy_cache_key(path)` to `cache_file`.
+
+    Lets caches written before the xxh3 switch keep serving instead of being
+    re-encoded. Only JPEG entries existed then. Returns True if a legacy file
+    was moved into place.
+    """
+    if xxhash is None or not cache_file.endswith(".jpg"):
+        return False
+    legacy_file = os.path.join(
+        os.path.dirname(cache_file), legacy_cache_key(path) + ".jpg"
+    )
+    try:
+        os.replace(legacy_file, cache_file)
+    except FileNotFoundError:
+        return False
+    try:
+        os.replace(legacy_file + ".json", cache_file + ".json")
+    except FileNotFoundError:
+        pass
+    forget_image_metadata(legacy_file)
+    with G.get_cache_lock():
+        _cache_lru().pop(legacy_file, None)
+    G.logger.info("[CacheManager] Adopted legacy cache file %s", legacy_file)
+    return True
+
+
+def atomic_write_bytes(filepath, data):
+    """Replace `filepath` with `data` via a temp file in the same directory.
+
+    Readers see either the old file or the complete new one, never a
+    partially written file, even if the process dies mid-write. Returns the
+    inode number of the new file.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(filepath), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            inode = os.fstat(f.fileno()).st_ino
+        os.replace(tmp_path, filepath)
+        tmp_path = None
+        return inode
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
 # --- Metadata utilities ---
 
 
@@ -38,8 +236,9 @@ def write_image_metadata(cache_file, width, height, mime_type="image/jpeg"):
     """
     meta_file = cache_file + ".json"
     try:
-        with open(meta_file, "w", encoding="utf-8") as f:
-            json.dump({"width": width, "height": height, "mime_type": mime_type}, f)
+        meta = {"width": width, "height": height, "mime_type": mime_type}
+        atomic_write_bytes(meta_file, json.dumps(meta).encode("utf-8"))
+        _remember_image_metadata(cache_file, (width, height, mime_type))
         return True
     except (OSError, IOError) as e:
         G.logger.warning(
@@ -52,9 +251,14 @@ def get_image_metadata(cache_file):
     """
     Return (width, height, mime_type) for a cached JPEG file.
 
-    If a metadata .json file exists, use it. Otherwise, open the image,
-    extract metadata, write the .json via write_image_metadata, and return.
+    Results are memoized in-process. On a memo miss, a metadata .json file
+    is used if it exists. Otherwise, open the image, extract metadata, write
+    the .json via write_image_metadata, and return.
     """
+    memo = _METADATA_MEMO.get(cache_file)
+    if memo is not None:
+        return memo
+
     meta_file = cache_file + ".json"
 
     # Try reading existing metadata file
@@ -62,7 +266,9 @@ def get_image_metadata(cache_file):
         try:
             with open(meta_file, "r", encoding="utf-8") as f:
                 meta = json.load(f)
-            return meta["width"], meta["height"], meta["mime_type"]
+            metadata = meta["width"], meta["height"], meta["mime_type"]
+            _remember_image_metadata(cache_file, metadata)
+            return metadata
         except (OSError, IOError, json.JSONDecodeError, KeyError) as e:
             G.logger.warning(
                 "[Metadata] Failed to read metadata file %s: %s", meta_file, e
@@ -84,6 +290,24 @@ def get_image_metadata(cache_file):
         return None, None, "image/jpeg"
 
 
+def _remember_image_metadata(cache_file, metadata):
+    """Memoize `metadata` for `cache_file`, dropping the oldest entry when full."""
+    if (
+        cache_file not in _METADATA_MEMO
+        and len(_METADATA_MEMO) >= _METADATA_MEMO_MAX
+    ):
+        _METADATA_MEMO.pop(next(iter(_METADATA_MEMO)), None)
+    _METADATA_MEMO[cache_file] = tuple(metadata)
+
+
+def forget_image_metadata(cache_file=None):
+    """Drop memoized metadata for `cache_file`, or for every file if None."""
+    if cache_file is None:
+        _METADATA_MEMO.clear()
+    else:
+        _METADATA_MEMO.pop(cache_file, None)
+
+
 # --- Date utilities ---
 
 
@@ -93,27 +317,147 @@ def parse_date_from_filename(filename):
     Recognizes `YYYYMMDD` and `YYYY-MM-DD` patterns and returns a
     `datetime.date` instance or `None` if no valid date is found.
     """
-    m1 = re.search(r"(\d{4})(\d{2})(\d{2})", filename)
-    if m1:
+    for match in _RE_FILENAME_DATE.finditer(filename):
         try:
-            return datetime.date(int(m1.group(1)), int(m1.group(2)), int(m1.group(3)))
+            return datetime.date(
+                int(match.group("y")), int(match.group("m")), int(match.group("d"))
+            )
         except ValueError as e:
             G.logger.error(
-                "[DateParser] Invalid YYYYMMDD in filename %s: %s", filename, e
+                "[DateParser] Invalid date %s in filename %s: %s",
+                match.group(0),
+                filename,
+                e,
             )
 
-    m2 = re.search(r"(\d{4})-(\d{2})-(\d{2})", filename)
-    if m2:
-        try:
-            return datetime.date(int(m2.group(1)), int(m2.group(2)), int(m2.group(3)))
-        except ValueError as e:
-            G.logger.error(
-                "[DateParser] Invalid YYYY-MM-DD in filename %s: %s", filename, e
+    return None
+
+
+def _read_ifd_tags(tiff, offset, endian, wanted):
+    """Return `{tag: (type, count, value)}` for `wanted` tags in one TIFF IFD."""
+    found = {}
+    try:
+        (count,) = struct.unpack_from(endian + "H", tiff, offset)
+        for i in range(count):
+            tag, typ, n, value = struct.unpack_from(
+                endian + "HHII", tiff, offset + 2 + 12 * i
             )
+            if tag in wanted:
+                found[tag] = (typ, n, value)
+    except struct.error:
+        pass
+    return found
+
+
+def _parse_exif_date(tiff, path):
+    """Return the first valid EXIF date in TIFF-structured `tiff` or `None`."""
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return None
+
+    try:
+        (ifd0,) = struct.unpack_from(endian + "I", tiff, 4)
+    except struct.error:
+        return None
 
+    tags = _read_ifd_tags(tiff, ifd0, endian, {_EXIF_IFD_POINTER, 0x0132})
+    if _EXIF_IFD_POINTER in tags:
+        exif_ifd = tags.pop(_EXIF_IFD_POINTER)[2]
+        tags.update(_read_ifd_tags(tiff, exif_ifd, endian, {0x9003, 0x9004}))
+
+    for tag in _EXIF_DATE_TAGS:
+        if tag not in tags:
+            continue
+        typ, n, value = tags[tag]
+        # ASCII values longer than 4 bytes are stored at `value` as an offset.
+        if typ != 2 or n <= 4:
+            continue
+        raw = tiff[value : value + n].rstrip(b"\x00 ").decode("ascii", "ignore")
+        try:
+            return datetime.datetime.strptime(raw, "%Y:%m:%d %H:%M:%S").date()
+        except ValueError as e:
+            G.logger.error("[DateParser] Bad EXIF date in %s: %s", path, e)
     return None
 
 
+def _read_jpeg_exif_date(path):
+    """Read the EXIF date of a JPEG by walking its header segments only.
+
+    Returns `(is_jpeg, date)`. Only marker headers and the APP1 payload are
+    read; no image data is decoded. `is_jpeg` is False when `path` does not
+    start with a JPEG SOI marker, so callers can fall back to Pillow.
+    """
+    with open(path, "rb") as fh:
+        if fh.read(2) != b"\xff\xd8":
+            return False, None
+        while True:
+            header = fh.read(4)
+            if len(header) < 4 or header[0] != 0xFF:
+                return True, None
+            marker = header[1]
+            # Start of scan / end of image: no APP1 segment before pixel data.
+            if marker in (0xDA, 0xD9):
+                return True, None
+            seg_len = int.from_bytes(header[2:4], "big") - 2
+            if seg_len < 0:
+                return True, None
+            if marker == 0xE1:
+                payload = fh.read(seg_len)
+                if payload[:6] == b"Exif\x00\x00":
+                    return True, _parse_exif_date(payload[6:], path)
+            else:
+                fh.seek(seg_len, os.SEEK_CUR)
+
+
+def ensure_heif_opener(path):
+    """Register pillow_heif's Pillow opener if `path` is a HEIC/HEIF file.
+
+    Deferred until the first such file so JPEG-only libraries never load
+    libheif. Returns True if `path` has a HEIF extension.
+    """
+    if os.path.splitext(path)[1].lower() not in _HEIF_EXTENSIONS:
+        return False
+    if not _HEIF_STATE["opener_registered"]:
+        with _HEIF_LOCK:
+            if not _HEIF_STATE["opener_registered"]:
+                from pillow_heif import register_heif_opener
+
+                # Only the primary image is ever decoded, so skip enumerating
+                # thumbnails, depth and auxiliary images.
+                register_heif_opener(
+                    thumbnails=False, depth_images=False, aux_images=False
+                )
+                _HEIF_STATE["opener_registered"] = True
+    return True
+
+
+def _read_heif_exif_date(path):
+    """Read the EXIF date of a HEIC/HEIF file without decoding its pixels.
+
+    Returns `(is_heif, date)` like `_read_jpeg_exif_date()`. `open_heif()`
+    only parses the container boxes; the EXIF block comes from its metadata.
+    Files that pillow_heif cannot parse report `is_heif` False so callers
+    fall back to Pillow.
+    """
+    if not ensure_heif_opener(path):
+        return False, None
+    import pillow_heif
+
+    try:
+        exif = pillow_heif.open_heif(path).info.get("exif")
+    except (ValueError, EOFError, SyntaxError, RuntimeError) as e:
+        G.logger.error("[DateParser] Cannot parse HEIF %s: %s", path, e)
+        return False, None
+    if not exif:
+        return True, None
+    if exif[:6] == b"Exif\x00\x00":
+        exif = exif[6:]
+    return True, _parse_exif_date(exif, path)
+
+
 def get_photo_date(path):
     """Return the best-effort `date` for `path`.
 
@@ -122,6 +466,9 @@ def get_photo_date(path):
       2. EXIF fields: `DateTimeOriginal`, `DateTimeDigitized`, `DateTime`.
       3. File modification time (mtime).
 
+    JPEG EXIF is read by scanning the file header directly and HEIC EXIF from
+    the container metadata; other formats are opened with Pillow.
+
     Returns a `datetime.date` or `None` if the date cannot be determined.
     """
     filename_date = parse_date_from_filename(os.path.basename(path))
@@ -129,27 +476,40 @@ def get_photo_date(path):
         return filename_date
 
     try:
-        with Image.open(path) as img:
-            exif = img.getexif()
-            if exif:
-                for tag, value in exif.items():
-                    tag_name = ExifTags.TAGS.get(tag, tag)
-                    if tag_name in (
-                        "DateTimeOriginal",
-                        "DateTimeDigitized",
-                        "DateTime",
-                    ):
+        header_parsed, exif_date = _read_jpeg_exif_date(path)
+        if not header_parsed:
+            header_parsed, exif_date = _read_heif_exif_date(path)
+    except OSError as e:
+        G.logger.error("[DateParser] I/O error reading %s: %s", path, e)
+        header_parsed, exif_date = True, None
+    if exif_date:
+        return exif_date
+
+    if not header_parsed:
+        try:
+            with Image.open(path) as img:
+                exif = img.getexif()
+                if exif:
+                    # DateTimeOriginal/Digitized live in the Exif IFD,
+                    # DateTime in IFD0; look the wanted tags up directly.
+                    exif_ifd = exif.get_ifd(_EXIF_IFD_POINTER)
+                    for tag in _EXIF_DATE_TAGS:
+                        value = exif_ifd.get(tag) or exif.get(tag)
+                        if not isinstance(value, str):
+                            continue
                         try:
-                            dt = datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+                            dt = datetime.datetime.strptime(
+                                value.strip("\x00 "), "%Y:%m:%d %H:%M:%S"
+                            )
                             return dt.date()
                         except ValueError as e:
                             G.logger.error(
                                 "[DateParser] Bad EXIF date in %s: %s", path, e
                             )
-    except UnidentifiedImageError as e:
-        G.logger.error("[DateParser] Cannot identify image %s: %s", path, e)
-    except OSError as e:
-        G.logger.error("[DateParser] I/O error reading %s: %s", path, e)
+        except UnidentifiedImageError as e:
+            G.logger.error("[DateParser] Cannot identify image %s: %s", path, e)
+        except OSError as e:
+            G.logger.error("[DateParser] I/O error reading %s: %s", path, e)
 
     try:
         ts = os.path.getmtime(path)
@@ -160,23 +520,237 @@ def get_photo_date(path):
     return None
 
 
+def get_cached_photo_date(path):
+    """Return `get_photo_date(path)`, memoized per path and mtime.
+
+    One stat() replaces re-reading the source on repeat picks; an edited or
+    replaced photo has a new mtime and is read again.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    return _photo_date_memo(path, mtime_ns)
+
+
+@functools.lru_cache(maxsize=4096)
+def _photo_date_memo(path, mtime_ns):
+    return get_photo_date(path)
+
+
+def open_date_cache():
+    """Open the persistent photo date cache under `G.CACHE_DIR`.
+
+    The SQLite table maps `(path, mtime, size)` to the resolved date so
+    `build_cache()` only re-reads EXIF for new or modified files.
+    Returns a connection, or `None` if the database cannot be opened.
+    """
+    db_path = os.path.join(G.CACHE_DIR, G.DATE_CACHE_FILENAME)
+    try:
+        conn = sqlite3.connect(
+            db_path, timeout=_DATE_CACHE_TIMEOUT, isolation_level=None
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS photo_dates ("
+            "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, date TEXT)"
+        )
+        return conn
+    except sqlite3.Error as e:
+        G.logger.warning("[DateCache] Failed to open date cache %s: %s", db_path, e)
+        return None
+
+
+def _resolve_photo_dates(paths, date_cache):
+    """Return photo dates for `paths`, in order.
+
+    Filename dates and unchanged entries in `date_cache` are answered in
+    the calling thread; the remaining files are resolved concurrently with
+    `get_photo_date()` and their results written back to `date_cache`.
+    """
+    dates = [None] * len(paths)
+    misses = []
+    for i, path in enumerate(paths):
+        filename_date = parse_date_from_filename(os.path.basename(path))
+        if filename_date:
+            dates[i] = filename_date
+            continue
+
+        st = None
+        if date_cache is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                pass
+            else:
+                row = date_cache.execute(
+                    "SELECT date FROM photo_dates WHERE path=? AND mtime=? AND size=?",
+                    (path, st.st_mtime, st.st_size),
+                ).fetchone()
+                if row is not None:
+                    dates[i] = datetime.date.fromisoformat(row[0]) if row[0] else None
+                    continue
+        misses.append((i, path, st))
+
+    if not misses:
+        return dates
+
+    pending = []
+    with ThreadPoolExecutor(max_workers=_BUILD_CACHE_WORKERS) as executor:
+        resolved = executor.map(get_photo_date, [path for _, path, _ in misses])
+        # SQLite writes stay on this thread; workers only read files.
+        for (i, path, st), photo_date in zip(misses, resolved):
+            dates[i] = photo_date
+            if st is not None:
+                pending.append(
+                    (
+                        path,
+                        st.st_mtime,
+                        st.st_size,
+                        photo_date.isoformat() if photo_date else "",
+                    )
+                )
+                if len(pending) >= _DATE_CACHE_BATCH:
+                    _flush_date_cache(date_cache, pending)
+    _flush_date_cache(date_cache, pending)
+    return dates
+
+
+def _resolve_dates_with_cache(paths, date_cache):
+    """Resolve dates for `paths` in one write transaction on `date_cache`.
+
+    `BEGIN IMMEDIATE` takes the write lock up front, so a concurrent build in
+    another process waits for it (up to `_DATE_CACHE_TIMEOUT`) instead of
+    failing on lock upgrade. If the cache still cannot be used, the dates are
+    resolved without it rather than failing the build.
+    """
+    if date_cache is not None:
+        try:
+            date_cache.execute("BEGIN IMMEDIATE")
+            dates = _resolve_photo_dates(paths, date_cache)
+            date_cache.execute("COMMIT")
+            return dates
+        except sqlite3.Error as e:
+            G.logger.warning(
+                "[DateCache] Date cache unavailable, resolving dates uncached: %s", e
+            )
+            if date_cache.in_transaction:
+                date_cache.execute("ROLLBACK")
+    return _resolve_photo_dates(paths, None)
+
+
+def _flush_date_cache(date_cache, pending):
+    """Write buffered `pending` rows to `date_cache` and clear the buffer."""
+    if date_cache is None or not pending:
+        pending.clear()
+        return
+    date_cache.executemany(
+        "INSERT OR REPLACE INTO photo_dates (path, mtime, size, date) "
+        "VALUES (?, ?, ?, ?)",
+        pending,
+    )
+    pending.clear()
+
+
+@functools.lru_cache(maxsize=4096)
 def format_date_with_suffix(dt):
-    """Return date formatted with ordinal suffix, e.g. `1st Jan 2020`."""
+    """Return date formatted with ordinal suffix, e.g. `1st Jan 2020`.
+
+    `dt` is a `datetime.date` from `get_photo_date()`; results are memoized
+    since every photo taken on one day renders the same label.
+    """
     day = dt.day
     if 11 <= day <= 13:
         suffix = "th"
     else:
-        suffix = {1: "st", 2: "nd", 3: "rd"}.get(day % 10, "th")
+        suffix = _ORDINAL_SUFFIXES.get(day % 10, "th")
     return f"{day}{suffix} {dt.strftime('%b %Y')}"
 
 
 # --- Cache management ---
 
 
+def _cache_lru():
+    """Return the LRU entries for `G.CACHE_DIR_PHOTO`, scanning it on first use.
+
+    Callers must hold the cache lock.
+    """
+    if _CACHE_LRU["dir"] != G.CACHE_DIR_PHOTO:
+        found = sorted(_scan_cache_dir())
+        _CACHE_LRU["entries"] = OrderedDict((f, mtime) for mtime, f in found)
+        _CACHE_LRU["dir"] = G.CACHE_DIR_PHOTO
+        G.CACHE_COUNT = len(found)
+    return _CACHE_LRU["entries"]
+
+
+def _scan_cache_dir():
+    """Return `(mtime, path)` for every cached image in `G.CACHE_DIR_PHOTO`."""
+    found = []
+    try:
+        it = os.scandir(G.CACHE_DIR_PHOTO)
+    except FileNotFoundError:
+        return found
+    # One stat() per cached file: is_file() comes from the dirent type.
+    with it:
+        for entry in it:
+            name = entry.name
+            if name.startswith(".") or name.endswith(".json"):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                found.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+    return found
+
+
+def _reconcile_cache_lru(entries):
+    """Re-read the cache directory into `entries`, keeping known recency.
+
+    Other gunicorn workers write to the same directory but keep their own
+    LRU, so files they added are only found here. Each file's last use is
+    the later of its mtime and this process's last hit on it.
+    Callers must hold the cache lock.
+    """
+    merged = sorted(
+        (max(mtime, entries.get(f, 0.0)), f) for mtime, f in _scan_cache_dir()
+    )
+    entries.clear()
+    entries.update((f, last_used) for last_used, f in merged)
+    G.CACHE_COUNT = len(entries)
+    return entries
+
+
+def load_cache_index():
+    """Scan the photo cache once so `G.CACHE_COUNT` reflects files on disk."""
+    with G.get_cache_lock():
+        _CACHE_LRU["dir"] = None
+        _cache_lru()
+
+
+def touch_cache_entry(cache_file):
+    """Mark `cache_file` as most recently used, adding it if it is new.
+
+    Without a cache limit nothing is ever pruned, so no LRU is kept.
+    """
+    if not G.CACHE_LIMIT_ENABLED:
+        return
+    with G.get_cache_lock():
+        entries = _cache_lru()
+        entries[cache_file] = time.time()
+        entries.move_to_end(cache_file)
+        G.CACHE_COUNT = len(entries)
+
+
 def prune_cache():
     """
     Prune the photo cache directory so total cached files <= G.CACHE_LIMIT.
 
+    Evicts least recently used entries from the in-memory LRU. The limit is
+    checked against this process's count first; only once that is over the
+    limit is the directory re-read (`_reconcile_cache_lru()`), so files other
+    workers wrote count too. Hits in other workers are not seen, so their
+    entries age by mtime.
     Preserves keys found in `G.SAME_DAY_KEYS`.
     Also removes any orphaned metadata files.
     Thread-safe operation using lock.
@@ -185,40 +759,70 @@ def prune_cache():
         return
 
     with G.get_cache_lock():
+        entries = _cache_lru()
+        if G.CACHE_COUNT <= G.CACHE_LIMIT:
+            return
+        entries = _reconcile_cache_lru(entries)
         if G.CACHE_COUNT <= G.CACHE_LIMIT:
             return
 
-        heap = []
-        for fn in os.listdir(G.CACHE_DIR_PHOTO):
-            if fn.startswith(".") or fn.endswith(".json"):
-                continue
-            f = os.path.join(G.CACHE_DIR_PHOTO, fn)
-            if not os.path.isfile(f):
-                continue
-            mtime = os.path.getmtime(f)
-            heapq.heappush(heap, (mtime, f))
-
-        while G.CACHE_COUNT > G.CACHE_LIMIT and heap:
-            mtime, f = heapq.heappop(heap)
-            key = os.path.basename(f).replace(".jpg", "")
+        retained = []
+        while entries and len(entries) + len(retained) > G.CACHE_LIMIT:
+            f, last_used = entries.popitem(last=False)
+            key = os.path.splitext(os.path.basename(f))[0]
             if key in G.SAME_DAY_KEYS:
                 G.logger.info("[CacheManager] Cache retained (same-day): %s", f)
+                retained.append((f, last_used))
                 continue
+            forget_image_metadata(f)
             try:
-                os.remove(f)
-                # Also remove the sidecar metadata file if it exists
-                meta_file = f + ".json"
-                if os.path.exists(meta_file):
-                    os.remove(meta_file)
-                G.CACHE_COUNT -= 1
+                # Remove the image and its sidecar metadata file; a missing
+                # file is already gone, so no exists() check is needed first.
+                for doomed in (f, f + ".json"):
+                    try:
+                        os.remove(doomed)
+                    except FileNotFoundError:
+                        pass
                 G.logger.info("[CacheManager] Cache pruned: removed %s", f)
             except OSError:
                 G.logger.warning("[CacheManager] Failed to remove cache file %s", f)
 
+        # Put retained entries back at the old end, preserving their order
+        for f, last_used in reversed(retained):
+            entries[f] = last_used
+            entries.move_to_end(f, last=False)
+        G.CACHE_COUNT = len(entries)
+
     # Clean up any orphaned metadata files (runs outside the lock for perf)
     prune_orphaned_metadata()
 
 
+def schedule_prune():
+    """Queue `prune_cache()` in the background once a batch of misses is due.
+
+    Does nothing while the cache is under `G.CACHE_LIMIT + _PRUNE_BATCH` or a
+    prune is already queued, so callers can invoke it after every write.
+    """
+    if not G.CACHE_LIMIT_ENABLED or G.CACHE_COUNT < G.CACHE_LIMIT + _PRUNE_BATCH:
+        return
+    with _PRUNE_LOCK:
+        if _PRUNE_STATE["scheduled"]:
+            return
+        _PRUNE_STATE["scheduled"] = True
+    _PRUNE_EXECUTOR.submit(_run_scheduled_prune)
+
+
+def _run_scheduled_prune():
+    """Background body for `schedule_prune()`."""
+    try:
+        prune_cache()
+    except Exception as e:  # pylint: disable=broad-except
+        G.logger.error("[CacheManager] Background prune failed: %s", e)
+    finally:
+        with _PRUNE_LOCK:
+            _PRUNE_STATE["scheduled"] = False
+
+
 def prune_orphaned_metadata():
     """
     Remove orphaned .json metadata files in the photo cache directory.
@@ -231,13 +835,14 @@ def prune_orphaned_metadata():
     """
     with G.get_cache_lock():
         removed_count = 0
-        for fn in os.listdir(G.CACHE_DIR_PHOTO):
+        names = set(os.listdir(G.CACHE_DIR_PHOTO))
+        for fn in names:
             if not fn.endswith(".json"):
                 continue
             meta_path = os.path.join(G.CACHE_DIR_PHOTO, fn)
-            # Corresponding image file: e.g., abc123.jpg.json -> abc123.jpg
-            image_path = meta_path[:-5]  # Remove .json suffix
-            if not os.path.exists(image_path):
+            # Corresponding image file: e.g., abc123.jpg.json -> abc123.jpg.
+            # Checked against the listing, so no stat() per sidecar.
+            if fn[:-5] not in names:
                 try:
                     os.remove(meta_path)
                     removed_count += 1
@@ -261,13 +866,12 @@ def clear_directory(path):
     if not os.path.isdir(path):
         raise ValueError(f"Not a directory: {path}")
 
-    for entry in os.listdir(path):
-        full_path = os.path.join(path, entry)
-
-        if os.path.isfile(full_path) or os.path.islink(full_path):
-            os.remove(full_path)
-        elif os.path.isdir(full_path):
-            shutil.rmtree(full_path)
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
 
 
 def clear_entire_cache():
@@ -276,8 +880,9 @@ def clear_entire_cache():
 
     Removes:
       - All files under G.CACHE_DIR_PHOTO and G.CACHE_DIR_ICON
-      - cache_all.txt
-      - cache_same_day.txt
+      - cache_all.txt / cache_all.idx
+      - cache_same_day.txt / cache_same_day.idx
+      - date_cache.db
 
     Resets:
       - G.CACHE_COUNT
@@ -310,7 +915,13 @@ def clear_entire_cache():
                 errors = True
 
         # 2. Remove cache text files
-        for txt in ("cache_all.txt", "cache_same_day.txt"):
+        for txt in (
+            "cache_all.txt",
+            "cache_same_day.txt",
+            "cache_all.idx",
+            "cache_same_day.idx",
+            G.DATE_CACHE_FILENAME,
+        ):
             txt_path = os.path.join(G.CACHE_DIR, txt)
             try:
                 os.remove(txt_path)
@@ -329,6 +940,10 @@ def clear_entire_cache():
                 errors = True
 
         # 3. Reset globals
+        _CACHE_LRU["entries"] = OrderedDict()
+        forget_image_metadata()
+        _photo_date_memo.cache_clear()
+        _CACHE_LRU["dir"] = G.CACHE_DIR_PHOTO
         G.CACHE_COUNT = 0
         G.SAME_DAY_KEYS = set()
         G.CACHE_DATE = None
@@ -367,93 +982,555 @@ def count_lines(filepath):
         return 0
 
 
-def build_cache(base_dir):
+def _index_path(filepath):
+    """Return the line-offset index path that accompanies cache file `filepath`."""
+    return os.path.splitext(filepath)[0] + ".idx"
+
+
+def count_lines_idx(idx_path):
+    """Return number of lines recorded in index `idx_path` or 0 if missing."""
+    try:
+        size = os.path.getsize(idx_path)
+    except FileNotFoundError:
+        return 0
+    return max(0, size - _INDEX_HEADER.size) // _INDEX_ENTRY.size
+
+
+def _line_maps(filepath, idx_path):
+    """Return read-only `(text, index)` maps for a cache file, or `None`.
+
+    Maps are reused across calls and re-created when either file is replaced or
+    appended to (new inode, size or mtime), so a rebuild is picked up on the
+    next lookup. A pair whose index header names another text inode is
+    retried briefly and then reported as `None`, like a missing file. Old
+    maps are never closed explicitly; in-flight readers keep them alive
+    and they are released once unreferenced.
+    """
+    for attempt in range(_LINE_PAIR_RETRIES + 1):
+        if attempt:
+            time.sleep(_LINE_PAIR_RETRY_DELAY)
+        try:
+            signature = _line_maps_signature(os.stat(idx_path), os.stat(filepath))
+        except FileNotFoundError:
+            return None
+        cached = _LINE_MAPS.get(idx_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        try:
+            with open(filepath, "rb") as f_text, open(idx_path, "rb") as f_idx:
+                text_stat = os.fstat(f_text.fileno())
+                idx_stat = os.fstat(f_idx.fileno())
+                header = f_idx.read(_INDEX_HEADER.size)
+                if (
+                    len(header) != _INDEX_HEADER.size
+                    or _INDEX_HEADER.unpack(header)[0] != text_stat.st_ino
+                ):
+                    continue
+                maps = (
+                    mmap.mmap(f_text.fileno(), 0, access=mmap.ACCESS_READ)
+                    if text_stat.st_size
+                    else b"",
+                    mmap.mmap(f_idx.fileno(), 0, access=mmap.ACCESS_READ),
+                )
+        except (FileNotFoundError, ValueError):
+            return None
+        _LINE_MAPS[idx_path] = (_line_maps_signature(idx_stat, text_stat), maps)
+        return maps
+    return None
+
+
+def _line_maps_signature(idx_stat, text_stat):
+    """Return the reuse key for maps of a text file and its index."""
+    return (
+        idx_stat.st_ino,
+        idx_stat.st_size,
+        idx_stat.st_mtime_ns,
+        text_stat.st_ino,
+        text_stat.st_size,
+        text_stat.st_mtime_ns,
+    )
+
+
+def get_line_idx(filepath, idx_path, file_line_idx):
+    """Return the 0-based `file_line_idx` line from `filepath` or `None`.
+
+    Looks up the line's byte offset in the memory-mapped `idx_path` and
+    slices that line out of the mapped text file, so a lookup costs two
+    stat() calls and no reads regardless of how many lines the file holds.
+    """
+    if file_line_idx < 0:
+        return None
+    maps = _line_maps(filepath, idx_path)
+    if maps is None:
+        return None
+    text, index = maps
+    entry_offset = _INDEX_HEADER.size + file_line_idx * _INDEX_ENTRY.size
+    if entry_offset + _INDEX_ENTRY.size > len(index):
+        return None
+    (offset,) = _INDEX_ENTRY.unpack_from(index, entry_offset)
+    end = text.find(b"\n", offset)
+    line = text[offset:] if end == -1 else text[offset:end]
+    return line.decode("utf-8").strip() or None
+
+
+def iter_image_paths(base_dir):
+    """Yield photo paths under `base_dir` using `os.scandir`.
+
+    Directory entries are classified from the dirent type, so no extra
+    `stat()` is issued per entry. Symlinked directories are not followed,
+    and directories whose name contains an `IGNORED_DIR_MARKERS` entry
+    are skipped along with everything below them.
+    """
+    stack = [base_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            it = os.scandir(current)
+        except OSError as e:
+            G.logger.warning("[CacheManager] Cannot scan directory %s: %s", current, e)
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    lowered = name.lower()
+                    if not any(marker in lowered for marker in IGNORED_DIR_MARKERS):
+                        stack.append(entry.path)
+                elif os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield entry.path
+
+
+def _write_line_file(filepath, lines):
+    """Write `lines` to `filepath` and their offsets to its `.idx`.
+
+    Each file is written with a single `write()` call to a temp file and
+    renamed into place, so mmaps held by `get_line_idx()` keep seeing the
+    old contents until they notice the new inode. The index header records
+    the new text file's inode, so readers can tell when the two renames have
+    only half happened.
+    """
+    encoded = [(line + "\n").encode("utf-8") for line in lines]
+    offsets = list(itertools.accumulate(map(len, encoded), initial=0))
+    text_inode = atomic_write_bytes(filepath, b"".join(encoded))
+    atomic_write_bytes(
+        _index_path(filepath),
+        _INDEX_HEADER.pack(text_inode)
+        + struct.pack(f"<{len(offsets) - 1}Q", *offsets[:-1]),
+    )
+    _WATCH_STATE["listed"][filepath] = {
+        "inode": text_inode,
+        "size": offsets[-1],
+        "paths": set(lines),
+    }
+
+
+def build_cache(base_dir, paths=None):
     """Scan `base_dir` and atomically rebuild cache files.
 
     Writes two line-oriented files into `G.CACHE_DIR`:
       - `cache_all.txt`: all photo paths not matching today's month/day
       - `cache_same_day.txt`: paths matching today's month/day across years
 
-    Also populates `G.SAME_DAY_KEYS` with MD5(path) keys to prevent
+    Each text file gets a companion `.idx` of uint64 line offsets so
+    `pick_file()` can fetch any line without scanning the file.
+
+    Also populates `G.SAME_DAY_KEYS` with `cache_key(path)` keys to prevent
     `prune_cache()` from deleting those JPEGs.
+
+    Photo dates are looked up in the persistent date cache first, so a
+    rebuild only opens images that are new or changed since the last scan;
+    those are read concurrently on a thread pool.
+
+    If `paths` is given, the tree walk is skipped and only those photos are
+    re-partitioned; the scheduled rebuild does this while the photo watcher
+    keeps the cache files current.
     """
     G.CACHE_DATE = None
     G.BUILDING_CACHE = True
     G.SAME_DAY_KEYS = set()
+    date_cache = open_date_cache()
 
     try:
         today = datetime.date.today()
-        extensions = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic")
-        ignore_dirs = {"thumbnails", "cache", ".git", "__pycache__", "@__thumb"}
         all_path = os.path.join(G.CACHE_DIR, "cache_all.txt")
         same_day_path = os.path.join(G.CACHE_DIR, "cache_same_day.txt")
 
-        with open(all_path, "w", encoding="utf-8") as f_all, open(
-            same_day_path, "w", encoding="utf-8"
-        ) as f_same:
-            for root, _, files in os.walk(base_dir):
-                if any(ign in root.lower() for ign in ignore_dirs):
-                    continue
-
-                for fn in files:
-                    if fn.lower().endswith(extensions):
-                        path = os.path.join(root, fn)
-                        photo_date = get_photo_date(path)
-                        if (
-                            photo_date
-                            and photo_date.month == today.month
-                            and photo_date.day == today.day
-                        ):
-                            f_same.write(path + "\n")
-                            key_hash = hashlib.md5(path.encode()).hexdigest()
-                            G.SAME_DAY_KEYS.add(key_hash)
-                        else:
-                            f_all.write(path + "\n")
+        if paths is None:
+            paths = list(iter_image_paths(base_dir))
+
+        dates = _resolve_dates_with_cache(paths, date_cache)
+
+        with _line_files_locked():
+            # Apply watcher events that arrived after `paths` was taken, and
+            # only forget the ones written here; later ones wait for the next
+            # rebuild.
+            deleted = set(_WATCH_STATE["deleted"])
+            added = dict(_WATCH_STATE["added"])
+            dated = [(p, d) for p, d in zip(paths, dates) if p not in deleted]
+            known = set(paths) | deleted
+            dated.extend((p, d) for p, d in added.items() if p not in known)
+
+            same_day_paths = []
+            other_paths = []
+            for path, photo_date in dated:
+                if (
+                    photo_date
+                    and photo_date.month == today.month
+                    and photo_date.day == today.day
+                ):
+                    same_day_paths.append(path)
+                    G.SAME_DAY_KEYS.add(cache_key(path))
+                else:
+                    other_paths.append(path)
+
+            _write_line_file(all_path, other_paths)
+            _write_line_file(same_day_path, same_day_paths)
+            _WATCH_STATE["deleted"] -= deleted
+            for path in added:
+                _WATCH_STATE["added"].pop(path, None)
 
         G.CACHE_DATE = today
     finally:
+        if date_cache is not None:
+            if date_cache.in_transaction:
+                date_cache.execute("ROLLBACK")
+            date_cache.close()
         G.BUILDING_CACHE = False
 
 
+def seconds_until_next_rebuild(now=None):
+    """Return seconds from `now` until shortly after the next local midnight."""
+    now = now or datetime.datetime.now()
+    next_midnight = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1), datetime.time()
+    )
+    return (next_midnight - now).total_seconds() + _REBUILD_DELAY_SECONDS
+
+
+def daily_rebuild_running():
+    """Return True if this process has a live background rebuild thread."""
+    thread = _REBUILD_STATE["thread"]
+    return thread is not None and thread.is_alive()
+
+
+def start_daily_rebuild(base_dir):
+    """Build the cache now and after every midnight on a daemon thread.
+
+    Keeps the daily scan out of the request path: `pick_file()` only rebuilds
+    while this thread runs if the cache files have gone missing, and routes
+    answer 503 while `G.BUILDING_CACHE` is set. Calling it again while the
+    thread is alive is a no-op.
+    """
+    if daily_rebuild_running():
+        return _REBUILD_STATE["thread"]
+
+    # Flag the build before the thread starts so early requests get a 503
+    # rather than racing it with a synchronous build.
+    G.BUILDING_CACHE = True
+    thread = threading.Thread(
+        target=_daily_rebuild_loop,
+        args=(base_dir,),
+        name="cache-rebuild",
+        daemon=True,
+    )
+    _REBUILD_STATE["thread"] = thread
+    thread.start()
+    return thread
+
+
+def _daily_rebuild_loop(base_dir):
+    """Rebuild the cache, then sleep until the next day and repeat.
+
+    The first pass walks `base_dir`. While the photo watcher is running,
+    later passes reuse the listed paths, since it has already applied the
+    changes since then; every `_WATCHED_REWALK_PASSES` passes walk the tree
+    again as a backstop for missed events.
+    """
+    passes_since_walk = None
+    while True:
+        try:
+            reuse = (
+                passes_since_walk is not None
+                and passes_since_walk < _WATCHED_REWALK_PASSES
+                and photo_watcher_running()
+            )
+            build_cache(base_dir, listed_photo_paths() if reuse else None)
+            passes_since_walk = passes_since_walk + 1 if reuse else 1
+            G.logger.info("[CacheManager] Scheduled cache rebuild finished")
+        except Exception as e:  # pylint: disable=broad-except
+            G.BUILDING_CACHE = False
+            G.logger.error("[CacheManager] Scheduled cache rebuild failed: %s", e)
+        time.sleep(seconds_until_next_rebuild())
+
+
+# --- Filesystem watcher ---
+
+
+def photo_watcher_running():
+    """Return True if this process has a live photo watcher."""
+    observer = _WATCH_STATE["observer"]
+    return observer is not None and observer.is_alive()
+
+
+def start_photo_watcher(base_dir):
+    """Watch `base_dir` and apply photo additions and removals in place.
+
+    New photos are appended to the cache files as soon as they are written,
+    and deleted ones are tombstoned so `pick_file()` skips them. "Written" is
+    the close-after-write event, which only Linux (inotify) reports; other
+    platforms pick up photos that arrive complete (moved or copied in with
+    their size already set) and leave the rest to the periodic re-walk in
+    `_daily_rebuild_loop()`. Requires the
+    optional `watchdog` package; returns None when it is not installed or the
+    tree cannot be watched. Calling it again while it runs is a no-op.
+    """
+    if photo_watcher_running():
+        return _WATCH_STATE["observer"]
+    if Observer is None:
+        G.logger.warning(
+            "[CacheManager] watchdog is not installed; photo watcher disabled"
+        )
+        return None
+
+    observer = Observer()
+    observer.daemon = True
+    try:
+        observer.schedule(_PhotoEventHandler(base_dir), base_dir, recursive=True)
+        observer.start()
+    except OSError as e:
+        G.logger.warning("[CacheManager] Cannot watch %s: %s", base_dir, e)
+        return None
+    _WATCH_STATE["observer"] = observer
+    G.logger.info("[CacheManager] Watching %s for photo changes", base_dir)
+    return observer
+
+
+def _is_watched_photo(path, base_dir):
+    """Return True if `iter_image_paths(base_dir)` would yield `path`."""
+    if os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+        return False
+    rel_dir = os.path.dirname(os.path.relpath(path, base_dir))
+    return not any(
+        marker in part.lower()
+        for part in rel_dir.split(os.sep)
+        for marker in IGNORED_DIR_MARKERS
+    )
+
+
+class _PhotoEventHandler(FileSystemEventHandler):
+    """Route watchdog events under the photo root to the cache files."""
+
+    def __init__(self, base_dir):
+        super().__init__()
+        self.base_dir = base_dir
+
+    def _handle(self, action, path):
+        if not _is_watched_photo(path, self.base_dir):
+            return
+        # A rewritten or removed photo may keep its mtime (copies with -p).
+        _photo_date_memo.cache_clear()
+        try:
+            action(path)
+        except (OSError, ValueError) as e:
+            G.logger.warning("[CacheManager] Cannot update cache for %s: %s", path, e)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self._handle(add_cached_photo, event.src_path)
+
+    def on_created(self, event):
+        # Files and directories moved in from outside the root only report a
+        # creation. A new file still being written is empty here and is added
+        # by on_closed() instead.
+        if event.is_directory:
+            for path in iter_image_paths(event.src_path):
+                self._handle(add_cached_photo, path)
+            return
+        try:
+            complete = os.path.getsize(event.src_path) > 0
+        except OSError:
+            return
+        if complete:
+            self._handle(add_cached_photo, event.src_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self._handle(remove_cached_photo, event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._handle(remove_cached_photo, event.src_path)
+            self._handle(add_cached_photo, event.dest_path)
+
+
+def add_cached_photo(path):
+    """Append `path` to the cache file for its date, unless already listed.
+
+    The line and its `.idx` offset are appended in place, so `pick_file()`
+    sees the photo without a rebuild. The photo is also recorded for the next
+    `build_cache()` to merge in, so a rebuild already walking the tree does
+    not drop it. Returns True if a line was written.
+    """
+    photo_date = get_photo_date(path)
+    today = datetime.date.today()
+    same_day = (
+        photo_date is not None
+        and photo_date.month == today.month
+        and photo_date.day == today.day
+    )
+    name = "cache_same_day.txt" if same_day else "cache_all.txt"
+    filepath = os.path.join(G.CACHE_DIR, name)
+    line = (path + "\n").encode("utf-8")
+
+    with _line_files_locked():
+        _WATCH_STATE["deleted"].discard(path)
+        _WATCH_STATE["added"][path] = photo_date
+        if not (os.path.exists(filepath) and os.path.exists(_index_path(filepath))):
+            return False
+        listed = _listed_paths(filepath)
+        if path in listed["paths"]:
+            return False
+        with open(filepath, "ab") as f:
+            f.write(line)
+        with open(_index_path(filepath), "ab") as f:
+            f.write(_INDEX_ENTRY.pack(listed["size"]))
+        listed["paths"].add(path)
+        listed["size"] += len(line)
+
+    if same_day:
+        G.SAME_DAY_KEYS.add(cache_key(path))
+    return True
+
+
+@contextlib.contextmanager
+def _line_files_locked():
+    """Hold the cache-list lock for this process and, via flock(), all others.
+
+    Gunicorn workers each run their own watcher and rebuild thread, so the
+    in-process lock alone would let two of them append the same photo.
+    """
+    with _LINE_FILE_LOCK:
+        if fcntl is None:
+            yield
+            return
+        lock_path = os.path.join(G.CACHE_DIR, _LINE_FILES_LOCK_NAME)
+        with open(lock_path, "a", encoding="utf-8") as lock_file:
+            # Released when the file is closed.
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+def _listed_paths(filepath):
+    """Return the `_WATCH_STATE["listed"]` entry for `filepath`, brought current.
+
+    Only bytes appended since the last call are read, whoever appended them.
+    A new inode or a shorter file means another worker rebuilt it, so it is
+    read again in full. Callers must hold `_line_files_locked()`.
+    """
+    st = os.stat(filepath)
+    listed = _WATCH_STATE["listed"].get(filepath)
+    if listed is None or listed["inode"] != st.st_ino or listed["size"] > st.st_size:
+        listed = {"inode": st.st_ino, "size": 0, "paths": set()}
+        _WATCH_STATE["listed"][filepath] = listed
+    if st.st_size > listed["size"]:
+        with open(filepath, "rb") as f:
+            f.seek(listed["size"])
+            tail = f.read(st.st_size - listed["size"])
+        listed["paths"].update(tail.decode("utf-8").splitlines())
+        listed["size"] += len(tail)
+    return listed
+
+
+def remove_cached_photo(path):
+    """Tombstone `path` so `pick_file()` skips it until a rebuild drops it."""
+    with _LINE_FILE_LOCK:
+        _WATCH_STATE["deleted"].add(path)
+
+
+def listed_photo_paths():
+    """Return the live paths listed in both cache files, minus tombstones."""
+    deleted = _WATCH_STATE["deleted"]
+    paths = []
+    for name in ("cache_all.txt", "cache_same_day.txt"):
+        try:
+            with open(os.path.join(G.CACHE_DIR, name), encoding="utf-8") as f:
+                paths.extend(line.rstrip("\n") for line in f)
+        except FileNotFoundError:
+            continue
+    return [p for p in paths if p and p not in deleted]
+
+
 def pick_file(base_dir):
     """Select the next photo path for the current session.
 
     Behavior:
-      - If the cache is stale or missing, rebuild via `build_cache()`.
+      - If the cache files are missing, or the cache is stale and no
+        background rebuild thread is running (see `start_daily_rebuild()`),
+        rebuild via `build_cache()`.
             - Serve same-day photos sequentially per-session using `session['photo_index']`.
             - Interleave non-same-day photos so same-day entries do not starve the
                 general pool. `G.SAME_DAY_CYCLE` controls max consecutive same-day
                 photos before forcing one random photo from `cache_all.txt`.
             - When same-day list is exhausted, pick a random line from `cache_all.txt`.
+            - Skip photos the watcher has tombstoned since the last rebuild.
 
     Returns a filesystem path string or `None` if no photos are available.
     """
     today = datetime.date.today()
     all_file = os.path.join(G.CACHE_DIR, "cache_all.txt")
     same_day_file = os.path.join(G.CACHE_DIR, "cache_same_day.txt")
-
-    if G.CACHE_DATE != today or not os.path.exists(all_file):
+    all_idx = _index_path(all_file)
+    same_day_idx = _index_path(same_day_file)
+
+    # The background thread only owns the scheduled daily rebuild. Missing or
+    # mismatched list files (e.g. after clear_entire_cache(), or an index from
+    # an older layout) are rebuilt here unless a
+    # build is already in progress, or /random would stay empty until midnight.
+    missing = (
+        _line_maps(all_file, all_idx) is None
+        or _line_maps(same_day_file, same_day_idx) is None
+    )
+    if (missing and not G.BUILDING_CACHE) or (
+        G.CACHE_DATE != today and not daily_rebuild_running()
+    ):
         build_cache(base_dir)
 
-    # Serve next same-day photo for this session
-    if "photo_date" not in session or session["photo_date"] != str(today):
-        session["photo_date"] = str(today)
-        session["photo_index"] = 0
-        session["photo_served"] = 0
-        session.pop("same_day_exhausted_date", None)
-
-    same_day_exhausted = session.get("same_day_exhausted_date") == str(today)
-
-    total = count_lines(all_file)
+    # Work on a local snapshot of the session and write it back once, so the
+    # cookie is only re-signed when the slideshow position actually changed.
+    today_str = str(today)
+    state = {
+        "photo_date": session.get("photo_date"),
+        "photo_index": session.get("photo_index", 0),
+        "photo_served": session.get("photo_served", 0),
+        "same_day_exhausted_date": session.get("same_day_exhausted_date"),
+    }
+    if state["photo_date"] != today_str:
+        state = {
+            "photo_date": today_str,
+            "photo_index": 0,
+            "photo_served": 0,
+            "same_day_exhausted_date": None,
+        }
+
+    total = count_lines_idx(all_idx)
     path = None
-    idx = session.get("photo_index", 0)
-
-    if not same_day_exhausted:
-        path = get_line(same_day_file, idx)
+    idx = state["photo_index"]
+
+    deleted = _WATCH_STATE["deleted"]
+    if state["same_day_exhausted_date"] != today_str:
+        path = get_line_idx(same_day_file, same_day_idx, idx)
+        while path and path in deleted:
+            idx += 1
+            path = get_line_idx(same_day_file, same_day_idx, idx)
         if not path:
-            session["same_day_exhausted_date"] = str(today)
+            state["same_day_exhausted_date"] = today_str
 
-    same_day_streak = session.get("photo_served", 0)
+    same_day_streak = state["photo_served"]
     max_same_day_streak = max(0, int(G.SAME_DAY_CYCLE))
 
     should_serve_same_day = bool(path) and (
@@ -461,14 +1538,46 @@ def pick_file(base_dir):
     )
 
     if should_serve_same_day:
-        session["photo_index"] = idx + 1
-        session["photo_served"] = same_day_streak + 1
-        return path
+        state["photo_index"] = idx + 1
+        state["photo_served"] = same_day_streak + 1
+    else:
+        path = None
+        if total > 0:
+            # Reset same-day streak whenever we inject a general random photo.
+            state["photo_served"] = 0
+            for _ in range(_TOMBSTONE_RETRIES):
+                start = random.randrange(total)
+                path = get_line_idx(all_file, all_idx, start)
+                if path not in deleted:
+                    break
+            else:
+                # Mostly tombstones: walk on from the last pick instead.
+                path = _next_live_line(all_file, all_idx, total, start, deleted)
+
+    _store_session_state(state)
+    return path
+
+
+def _next_live_line(path, idx_path, total, start, deleted):
+    """Return the first line from `start` (wrapping) not in `deleted`, or None."""
+    for offset in range(total):
+        line = get_line_idx(path, idx_path, (start + offset) % total)
+        if line and line not in deleted:
+            return line
+    return None
 
-    if total > 0:
-        # Reset same-day streak whenever we inject a general random photo.
-        session["photo_served"] = 0
-        rand_idx = random.randrange(total)
-        return get_line(all_file, rand_idx)
 
-    return None
+def _store_session_state(state):
+    """Write changed slideshow keys back to the session in one update.
+
+    Keys whose value is None are removed. Untouched sessions are left alone so
+    Flask does not re-serialize and re-sign the cookie.
+    """
+    stale = [k for k, v in state.items() if v is None and k in session]
+    changed = {
+        k: v for k, v in state.items() if v is not None and session.get(k) != v
+    }
+    for key in stale:
+        session.pop(key)
+    if changed:
+        session.update(changed)
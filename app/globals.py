@@ -7,13 +7,13 @@ and configuration loaded from config.yaml.
 
 import os
 import logging
+import queue
 import threading
 import atexit
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
 from flask import Flask
-from pillow_heif import register_heif_opener
 from .config_manager import load_config
 from .image_utils import cleanup_requests_session
 
@@ -54,9 +54,13 @@ def _resolve_secret_key() -> str:
 # Initialize Flask app
 app = Flask(__name__, template_folder=TEMPLATE_DIR, static_folder=STATIC_DIR)
 app.secret_key = _resolve_secret_key()
+# Only send Set-Cookie when the slideshow state actually changed.
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
 
-# Register HEIF opener so Pillow can read HEIC files
-register_heif_opener()
+# Hand file responses to a fronting nginx/Apache via X-Sendfile when enabled.
+# Only turn this on behind a server that honours the header; otherwise the
+# response body is empty.
+app.use_x_sendfile = bool(CONFIG.get("app", {}).get("use_x_sendfile", False))
 
 
 def _resolve_configured_dir(
@@ -78,6 +82,13 @@ def _resolve_configured_dir(
 MAX_WIDTH = CONFIG["image"]["max_width"]
 MAX_HEIGHT = CONFIG["image"]["max_height"]
 
+# Cached image formats in preference order; the first one the client's
+# Accept header lists is served, with JPEG as the universal fallback.
+OUTPUT_FORMATS = [
+    "JPEG" if str(fmt).upper() == "JPG" else str(fmt).upper()
+    for fmt in CONFIG["image"].get("output_formats", ["jpeg"])
+]
+
 # Cache settings
 CACHE_LIMIT_ENABLED = CONFIG["cache"]["limit_enabled"]
 CACHE_LIMIT = CONFIG["cache"]["limit"]
@@ -103,14 +114,16 @@ CACHE_DIR_LOG = _resolve_configured_dir(
 CACHE_DIR_NAME = "cache"
 CACHE_ALL_FILENAME = "cache_all.txt"
 CACHE_SAME_DAY_FILENAME = "cache_same_day.txt"
+DATE_CACHE_FILENAME = "date_cache.db"
 CACHE_PHOTOS_SUBDIR = "photos"
 CACHE_ICONS_SUBDIR = "icons"
+CACHE_SESSIONS_SUBDIR = "sessions"
 
 # Logging
 LOG_DIR_NAME = "log"
 LOG_FILENAME = "photomatic.log"
 
-# Keys used by prune_cache() and populated at runtime with MD5 keys for
+# Keys used by prune_cache() and populated at runtime with cache_key() values for
 # same-day images that must be preserved. Using set for O(1) lookup.
 SAME_DAY_KEYS: set[str] = set()
 
@@ -167,9 +180,63 @@ log_handler = RotatingFileHandler(
 formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 log_handler.setFormatter(formatter)
 
+# Request threads only enqueue records; a listener thread formats them and
+# does the (locked) file write and rotation.
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, log_handler, respect_handler_level=True)
+log_listener.start()
+
 logger = logging.getLogger("slideshow")
 logger.setLevel(logging.INFO)
-logger.addHandler(log_handler)
+logger.addHandler(QueueHandler(log_queue))
+
+# Server-side sessions keep only a session id in the cookie; the slideshow
+# counters live in a store shared by every gunicorn worker.
+SESSION_BACKEND = str(CONFIG.get("app", {}).get("session_backend", "cookie")).lower()
+CACHE_DIR_SESSION = os.path.join(CACHE_DIR, CACHE_SESSIONS_SUBDIR)
+
+
+def _configure_sessions(backend: str) -> None:
+    """Install a Flask-Session interface for `backend` ('filesystem' or 'redis').
+
+    'cookie', a missing flask-session/redis package or an unknown backend
+    keeps Flask's signed-cookie sessions.
+    """
+    if backend == "cookie":
+        return
+    try:
+        from flask_session import Session
+
+        if backend == "redis":
+            import redis
+
+            redis_url = CONFIG["app"].get(
+                "session_redis_url", "redis://localhost:6379/0"
+            )
+            app.config.update(
+                SESSION_TYPE="redis", SESSION_REDIS=redis.from_url(redis_url)
+            )
+        elif backend == "filesystem":
+            from cachelib import FileSystemCache
+
+            app.config.update(
+                SESSION_TYPE="cachelib",
+                SESSION_CACHELIB=FileSystemCache(CACHE_DIR_SESSION, threshold=500),
+            )
+        else:
+            logger.warning("Unknown session_backend %r; using cookie sessions", backend)
+            return
+    except ImportError as e:
+        logger.warning(
+            "Session backend %s unavailable (%s); using cookie sessions", backend, e
+        )
+        return
+
+    app.config["SESSION_PERMANENT"] = False
+    Session(app)
+
+
+_configure_sessions(SESSION_BACKEND)
 
 # ============ Mutable State (shared across modules) ============
 PHOTO_ROOT = None
@@ -183,6 +250,13 @@ def _cleanup_resources():
     """Clean up resources on application shutdown."""
     logger.info("Cleaning up application resources...")
 
+    # Flush queued records to the file before closing it
+    try:
+        log_listener.stop()
+    except (AttributeError, RuntimeError) as e:
+        print(f"Error stopping log listener: {e}")
+    log_handler.close()
+
     # Close logging handlers to release file handles
     for handler in logger.handlers[:]:
         try:
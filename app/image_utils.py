@@ -2,33 +2,73 @@
 
 This module handles reading images via Pillow, normalizing orientation,
 resizing to configured limits, drawing optional overlay text, and
-writing/reading cached JPEGs under the Flask instance cache directory.
+writing/reading cached images (JPEG, or WebP/AVIF when the client accepts
+them) under the Flask instance cache directory.
 """
 
 import atexit
-import hashlib
+import functools
+import math
 import os
+import tempfile
+import threading
 import time
 
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from PIL import ExifTags, Image, ImageDraw, ImageFont, ImageOps, features
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from . import globals as G
-from .cache_manager import prune_cache, write_image_metadata
+from .cache_manager import (
+    adopt_legacy_cache_file,
+    cache_key,
+    ensure_heif_opener,
+    schedule_prune,
+    touch_cache_entry,
+    write_image_metadata,
+)
 
 # HTTP session for connection pooling and reuse
 _SESSION_CONTAINER: dict[str, requests.Session | None] = {"session": None}
+_SESSION_LOCK = threading.Lock()
+
+# Keep-alive pools per host (met.no, open-meteo, icon CDN). Sized for the
+# request threads plus the icon download executor sharing one session.
+_HTTP_POOL_CONNECTIONS = 8
+_HTTP_POOL_MAXSIZE = 16
+_HTTP_USER_AGENT = "PhotomaticWeatherDisplay/1.0"
 
 
 def get_requests_session():
     """Get or create a persistent requests session for connection pooling."""
     if _SESSION_CONTAINER["session"] is None:
-        _SESSION_CONTAINER["session"] = requests.Session()
-        # Register cleanup on app shutdown
-        atexit.register(cleanup_requests_session)
+        with _SESSION_LOCK:
+            if _SESSION_CONTAINER["session"] is None:
+                _SESSION_CONTAINER["session"] = _create_requests_session()
+                # Register cleanup on app shutdown
+                atexit.register(cleanup_requests_session)
     return _SESSION_CONTAINER["session"]
 
 
+def _create_requests_session() -> requests.Session:
+    """Build the shared session: pooled keep-alive adapters, one quick retry.
+
+    met.no rejects requests without an identifying User-Agent, so it is set
+    once on the session rather than per call.
+    """
+    session_obj = requests.Session()
+    session_obj.headers["User-Agent"] = _HTTP_USER_AGENT
+    adapter = HTTPAdapter(
+        pool_connections=_HTTP_POOL_CONNECTIONS,
+        pool_maxsize=_HTTP_POOL_MAXSIZE,
+        max_retries=Retry(total=1, backoff_factor=0.2),
+    )
+    session_obj.mount("https://", adapter)
+    session_obj.mount("http://", adapter)
+    return session_obj
+
+
 def cleanup_requests_session():
     """Clean up the requests session on shutdown."""
     if _SESSION_CONTAINER["session"] is not None:
@@ -36,14 +76,111 @@ def cleanup_requests_session():
         _SESSION_CONTAINER["session"] = None
 
 
+# Cache output formats: Pillow format name -> (file extension, MIME type)
+OUTPUT_FORMATS = {
+    "AVIF": ("avif", "image/avif"),
+    "WEBP": ("webp", "image/webp"),
+    "JPEG": ("jpg", "image/jpeg"),
+}
+
+# Encoder options per output format (quality is passed separately).
+# JPEGs are saved as baseline with optimized Huffman tables; see
+# _save_options() for when progressive mode is used instead. Chroma is
+# pinned to 4:2:0 (subsampling=2): 4:4:4 costs about 30% more bytes on
+# photos, and the "web_high" qtables preset larger still at the same quality.
+_JPEG_SUBSAMPLING = 2
+_SAVE_OPTIONS = {
+    "AVIF": {"speed": 8},
+    "WEBP": {"method": 4},
+    "JPEG": {"optimize": True, "subsampling": _JPEG_SUBSAMPLING},
+}
+
+# JPEGs with at least this many pixels are saved progressive. libjpeg-turbo
+# takes about twice as long for a progressive encode as for an optimized
+# baseline one. On full-size slides that buys about 2% fewer bytes
+# plus a coarse-to-fine render; on smaller images the files come out the same
+# size or larger.
+_PROGRESSIVE_MIN_PIXELS = 1_000_000
+
+# Formats whose decoder supports draft() DCT scaling. Camera and phone
+# "JPEGs" with an embedded preview frame open as MPO but decode the same way.
+_DRAFT_FORMATS = frozenset({"JPEG", "MPO"})
+
+# Colour transparent source pixels are flattened onto (the page background).
+_TRANSPARENT_FILL = (0, 0, 0)
+
+# EXIF orientations that transpose the image by 90 or 270 degrees.
+_ROTATED_ORIENTATIONS = frozenset({5, 6, 7, 8})
+
+# Per-cache-file locks so concurrent misses for one image encode it only once
+_CACHE_FILE_LOCKS: dict[str, threading.Lock] = {}
+_CACHE_FILE_LOCKS_GUARD = threading.Lock()
+
+# Caps concurrent decode/encode work at the core count. Pillow releases the GIL
+# in libjpeg and resampling, so encodes scale to the cores but no further.
+_ENCODE_SLOTS = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+# Formats this Pillow build can actually encode
+_SUPPORTED_FORMATS = {
+    fmt for fmt in OUTPUT_FORMATS if fmt == "JPEG" or features.check(fmt.lower())
+}
+
+
+def log_image_backend() -> None:
+    """Log the Pillow build's JPEG library and usable output formats.
+
+    The encode path assumes libjpeg-turbo's SIMD DCT and draft() IDCT
+    scaling; a Pillow built against plain libjpeg is logged as a warning.
+    """
+    turbo_version = features.version_feature("libjpeg_turbo")
+    G.logger.info(
+        "[ImageProcessor] Pillow %s | JPEG library: %s %s | Output formats: %s",
+        Image.__version__,
+        "libjpeg-turbo" if turbo_version else "libjpeg",
+        turbo_version or features.version_codec("jpg"),
+        ", ".join(output_format_preference()),
+    )
+    if not turbo_version:
+        G.logger.warning(
+            "[ImageProcessor] Pillow is not linked against libjpeg-turbo; "
+            "JPEG encode and decode will be several times slower"
+        )
+
+
+def mime_type_for(cache_file: str) -> str:
+    """Return the MIME type of a cached image from its file extension."""
+    extension = os.path.splitext(cache_file)[1].lstrip(".").lower()
+    for ext, mime_type in OUTPUT_FORMATS.values():
+        if ext == extension:
+            return mime_type
+    return "image/jpeg"
+
+
+def output_format_preference() -> list[str]:
+    """Return enabled output formats in preference order, always ending in JPEG."""
+    preferred = [
+        fmt
+        for fmt in G.OUTPUT_FORMATS
+        if fmt in _SUPPORTED_FORMATS and fmt != "JPEG"
+    ]
+    return preferred + ["JPEG"]
+
+
 FONT_PATH = os.path.join(
     os.path.dirname(__file__), "assets", "fonts", "NotoSans-Regular.ttf"
 )
 
-# Font cache to avoid repeated disk reads and object creation
-# LRU-style: keep only a few common sizes (keyed by font_size)
-_FONT_CACHE: dict[int, ImageFont.FreeTypeFont | ImageFont.ImageFont] = {}
-_MAX_FONT_CACHE = 10  # Typically only 1-2 sizes used
+# Fonts are cached per size; typically only 1-2 sizes are ever used
+_MAX_FONT_CACHE = 10
+
+# Overlay text measurements cached per (text, size, mode). Dates and age
+# labels repeat across photos and across the four corners.
+_MAX_TEXT_BBOX_CACHE = 512
+
+# Rendered shadow/foreground glyph masks cached per (text, size, mode), and
+# the image modes they can be pasted onto with plain colour fills.
+_MAX_TEXT_TILE_CACHE = 256
+_TEXT_TILE_MODES = frozenset({"RGB", "RGBA", "L"})
 
 
 def draw_text(draw, font, text, x, y):
@@ -52,27 +189,69 @@ def draw_text(draw, font, text, x, y):
     draw.text((x, y), text, font=font, fill="white")  # foreground
 
 
-def load_scaled_font(height, scale=0.01):
-    """Load a truetype font scaled to image height, using cache."""
-    font_size = max(12, int(height * scale))
+def paste_text(img, text, font_size, x, y, fontmode="L"):
+    """Paste `draw_text()` output from cached glyph masks instead of drawing.
 
-    # Return cached font if available
-    if font_size in _FONT_CACHE:
-        return _FONT_CACHE[font_size]
+    `img` must be in one of `_TEXT_TILE_MODES`; the result is identical to
+    drawing with the overlay font at `font_size`.
+    """
+    (dx, dy), shadow, foreground = _text_tile(text, font_size, fontmode)
+    img.paste("black", (x + dx, y + dy), shadow)
+    img.paste("white", (x + dx, y + dy), foreground)
 
-    # Load font and cache it
+
+@functools.lru_cache(maxsize=_MAX_FONT_CACHE)
+def _cached_font(font_size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
+    """Load the overlay font at `font_size` once per process."""
     try:
-        font = ImageFont.truetype(FONT_PATH, font_size)
+        return ImageFont.truetype(FONT_PATH, font_size)
     except OSError:
-        font = ImageFont.load_default()
+        return ImageFont.load_default()
+
+
+def _scaled_font_size(height, scale=0.01):
+    """Return the overlay font size for an image `height` pixels tall."""
+    return max(12, int(height * scale))
+
+
+def load_scaled_font(height, scale=0.01):
+    """Load a truetype font scaled to image height, using cache."""
+    return _cached_font(_scaled_font_size(height, scale))
+
+
+@functools.lru_cache(maxsize=_MAX_TEXT_TILE_CACHE)
+def _text_tile(
+    text: str, font_size: int, mode: str
+) -> tuple[tuple[int, int], Image.Image, Image.Image]:
+    """Render the shadow and foreground masks of `text` once.
+
+    Returns the tile's offset from the text origin (negative when glyphs
+    overhang it) and two "L" masks covering both the text and its 2 px
+    shadow.
+    """
+    left, top, right, bottom = _text_bbox(text, font_size, mode)
+    dx, dy = min(left, 0), min(top, 0)
+    size = (right - dx + 2, bottom - dy + 2)
+    font = _cached_font(font_size)
+    masks = []
+    for offset in (2, 0):
+        mask = Image.new("L", size)
+        draw = ImageDraw.Draw(mask)
+        draw.fontmode = mode
+        draw.text((offset - dx, offset - dy), text, font=font, fill=255)
+        masks.append(mask)
+    return (dx, dy), masks[0], masks[1]
 
-    # Enforce cache limit (simple FIFO eviction)
-    if len(_FONT_CACHE) >= _MAX_FONT_CACHE:
-        oldest_key = next(iter(_FONT_CACHE))
-        del _FONT_CACHE[oldest_key]
 
-    _FONT_CACHE[font_size] = font
-    return font
+@functools.lru_cache(maxsize=_MAX_TEXT_BBOX_CACHE)
+def _text_bbox(text: str, font_size: int, mode: str) -> tuple[int, int, int, int]:
+    """Return the bounding box of `text` drawn at (0, 0) in the overlay font."""
+    return _cached_font(font_size).getbbox(text, mode=mode)
+
+
+# Preload the floor size: at 1% of height, every image up to 1200 px tall
+# (including the default max_height) renders overlays at this size.
+load_scaled_font(0)
 
 
 def apply_overlays(img, overlays: dict[str, str]):
@@ -80,19 +259,19 @@ def apply_overlays(img, overlays: dict[str, str]):
     draw = ImageDraw.Draw(img)
     width, height = img.size
 
-    font = load_scaled_font(height, scale=0.01)
+    font_size = _scaled_font_size(height, scale=0.01)
+    font = _cached_font(font_size)
+    padding = int(height * 0.02)  # scale padding too
 
     for position, text in overlays.items():
         if not text:
             continue
 
-        # Measure text
-        bbox = draw.textbbox((0, 0), text, font=font)
+        # Measure text (memoized; same result as draw.textbbox at the origin)
+        bbox = _text_bbox(text, font_size, draw.fontmode)
         tw = bbox[2] - bbox[0]
         th = bbox[3] - bbox[1]
 
-        padding = int(height * 0.02)  # scale padding too
-
         if position == "top_left":
             x, y = padding, padding
 
@@ -111,40 +290,159 @@ def apply_overlays(img, overlays: dict[str, str]):
         else:
             continue
 
-        draw_text(draw, font, text, x, y)
+        if img.mode in _TEXT_TILE_MODES:
+            paste_text(img, text, font_size, x, y, draw.fontmode)
+        else:
+            draw_text(draw, font, text, x, y)
+
+
+def _fit_limits(rotated: bool) -> tuple[int, int]:
+    """Return `(MAX_WIDTH, MAX_HEIGHT)` in stored-pixel axes.
+
+    EXIF orientations 5-8 swap the axes on transpose, so a sideways-stored
+    image must fit the limits the other way round.
+    """
+    return (G.MAX_HEIGHT, G.MAX_WIDTH) if rotated else (G.MAX_WIDTH, G.MAX_HEIGHT)
+
+
+def _draft_size(width: int, height: int, rotated: bool = False) -> tuple[int, int]:
+    """Return the smallest size a JPEG `draft()` may decode `width`x`height` to.
+
+    Keeps 2x headroom over the final fit inside `MAX_WIDTH`x`MAX_HEIGHT`
+    so the LANCZOS thumbnail still has real pixels to resample.
+    """
+    max_width, max_height = _fit_limits(rotated)
+    scale = min(max_width / width, max_height / height)
+    return math.ceil(width * scale * 2), math.ceil(height * scale * 2)
 
 
 def resize_and_compress(
     path: str,
     overlays: dict[str, str] | None = None,
     quality: int = 75,
+    fmt: str = "JPEG",
 ) -> str:
     """
     Resize/compress image with optional overlay text, using local cache.
-    Returns the path to the cached JPEG file.
+    `fmt` selects the output format from `OUTPUT_FORMATS` (default JPEG).
+    Returns the path to the cached image file.
+    Concurrent misses for the same cache file are encoded only once, and at
+    most `os.cpu_count()` encodes run at a time.
     Ensures proper resource cleanup even on exceptions.
     """
     start_time = time.perf_counter()
     overlays = overlays or {}
+    if fmt not in _SUPPORTED_FORMATS:
+        fmt = "JPEG"
+    extension = OUTPUT_FORMATS[fmt][0]
 
-    key_hash = hashlib.md5(path.encode()).hexdigest()
-    cache_file = os.path.join(G.CACHE_DIR_PHOTO, f"{key_hash}.jpg")
+    key_hash = cache_key(path)
+    cache_file = os.path.join(G.CACHE_DIR_PHOTO, f"{key_hash}.{extension}")
 
     # --- Cache check ---
-    if os.path.exists(cache_file):
-        G.logger.info(
-            "[ImageProcessor] Cache hit for %s (size %.1f KB)",
-            path,
-            os.path.getsize(cache_file) / 1024,
-        )
-        return cache_file
+    # One stat(2) answers both "is it cached?" and the size for the log line.
+    st = _stat_or_none(cache_file)
+    if st is not None:
+        return _cache_hit(path, cache_file, st.st_size)
+
+    # Only one thread encodes a given cache file; others wait and then read it.
+    lock = _cache_file_lock(cache_file)
+    with lock:
+        try:
+            st = _stat_or_none(cache_file)
+            if st is None and adopt_legacy_cache_file(path, cache_file):
+                st = _stat_or_none(cache_file)
+            if st is not None:
+                return _cache_hit(path, cache_file, st.st_size)
+            with _ENCODE_SLOTS:
+                return _encode_to_cache(
+                    path, cache_file, key_hash, overlays, quality, fmt, start_time
+                )
+        finally:
+            _release_cache_file_lock(cache_file, lock)
+
+
+def _stat_or_none(cache_file: str) -> os.stat_result | None:
+    """Return `os.stat(cache_file)`, or None if it does not exist."""
+    try:
+        return os.stat(cache_file)
+    except FileNotFoundError:
+        return None
+
+
+def _cache_hit(path: str, cache_file: str, size: int) -> str:
+    """Record and log a cache hit of `size` bytes, returning `cache_file`."""
+    touch_cache_entry(cache_file)
+    G.logger.info(
+        "[ImageProcessor] Cache hit for %s (size %.1f KB)", path, size / 1024
+    )
+    return cache_file
+
+
+def _cache_file_lock(cache_file: str) -> threading.Lock:
+    """Return the lock guarding the encode of `cache_file`."""
+    with _CACHE_FILE_LOCKS_GUARD:
+        return _CACHE_FILE_LOCKS.setdefault(cache_file, threading.Lock())
+
+
+def _release_cache_file_lock(cache_file: str, lock: threading.Lock) -> None:
+    """Drop the lock entry once its cache file is settled.
+
+    Threads already waiting hold their own reference; later arrivals find the
+    file on disk (or create a fresh lock after a failed encode).
+    """
+    with _CACHE_FILE_LOCKS_GUARD:
+        if _CACHE_FILE_LOCKS.get(cache_file) is lock:
+            del _CACHE_FILE_LOCKS[cache_file]
+
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+    """Return an RGB copy of `img`, flattening any transparency onto black.
 
+    A plain convert("RGB") keeps whatever colour transparent pixels happen
+    to store; compositing onto the slideshow's black background shows them
+    as intended.
+    """
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        rgba = img if img.mode == "RGBA" else img.convert("RGBA")
+        try:
+            background = Image.new("RGB", rgba.size, _TRANSPARENT_FILL)
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            return background
+        finally:
+            if rgba is not img:
+                rgba.close()
+    return img.convert("RGB")
+
+
+def _save_options(fmt: str, size: tuple[int, int]) -> dict:
+    """Return encoder options for saving an image of `size` as `fmt`."""
+    options = _SAVE_OPTIONS[fmt]
+    if fmt == "JPEG" and size[0] * size[1] >= _PROGRESSIVE_MIN_PIXELS:
+        # Progressive scans already use optimized Huffman tables.
+        return {"progressive": True, "subsampling": _JPEG_SUBSAMPLING}
+    return options
+
+
+def _encode_to_cache(
+    path: str,
+    cache_file: str,
+    key_hash: str,
+    overlays: dict[str, str],
+    quality: int,
+    fmt: str,
+    start_time: float,
+) -> str:
+    """Decode `path`, resize, draw overlays and atomically write `cache_file`."""
+    extension, mime_type = OUTPUT_FORMATS[fmt]
     original_size = os.path.getsize(path)
     rgb_img = None
+    tmp_path = None
     transposed_img = None
     transposed_is_copy = False
     original_width, original_height = 0, 0
     final_width, final_height = 0, 0
+    compressed_size = 0
     was_resized = False
     was_transposed = False
 
@@ -156,10 +454,25 @@ def resize_and_compress(
     )
 
     try:
+        ensure_heif_opener(path)
         with Image.open(path) as img:
             original_width, original_height = img.size
             original_mode = img.mode
 
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale before any pixels
+            # are materialized; exif_transpose below would otherwise load
+            # the full-resolution image. The limits are taken in the axes
+            # the image is stored in, which EXIF rotation may swap.
+            orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+            rotated = orientation in _ROTATED_ORIENTATIONS
+            max_width, max_height = _fit_limits(rotated)
+            if img.format in _DRAFT_FORMATS and (
+                original_width > max_width or original_height > max_height
+            ):
+                img.draft(
+                    "RGB", _draft_size(original_width, original_height, rotated)
+                )
+
             # exif_transpose may return a new image or the same image
             transposed_img = ImageOps.exif_transpose(img)
             transposed_is_copy = transposed_img is not img
@@ -178,38 +491,52 @@ def resize_and_compress(
             if overlays:
                 apply_overlays(work_img, overlays)
 
-            # Save to cache - convert creates a new image
-            rgb_img = work_img.convert("RGB")
-            rgb_img.save(
-                cache_file,
-                format="JPEG",
-                quality=quality,
-                optimize=True,
-                progressive=True,
-            )
+            # Save to a hidden temp file and rename so readers never see a
+            # partially written cache entry. Only non-RGB images are
+            # converted; convert() would otherwise copy every pixel.
+            if work_img.mode != "RGB":
+                rgb_img = _to_rgb(work_img)
+            out_img = work_img if rgb_img is None else rgb_img
+            with tempfile.NamedTemporaryFile(
+                dir=G.CACHE_DIR_PHOTO,
+                prefix=".",
+                suffix=f".{extension}",
+                delete=False,
+            ) as tmp:
+                tmp_path = tmp.name
+                out_img.save(
+                    tmp,
+                    format=fmt,
+                    quality=quality,
+                    **_save_options(fmt, out_img.size),
+                )
+                # The encoder wrote straight to the file; its offset is the
+                # compressed size, so the cache file need not be stat()ed.
+                compressed_size = tmp.tell()
+            os.replace(tmp_path, cache_file)
+            tmp_path = None
 
             # Write metadata file (use final dimensions after thumbnail)
-            final_width, final_height = rgb_img.size
-            write_image_metadata(cache_file, final_width, final_height, "image/jpeg")
+            final_width, final_height = out_img.size
+            write_image_metadata(cache_file, final_width, final_height, mime_type)
 
-            with G.get_cache_lock():
-                G.CACHE_COUNT += 1
+            touch_cache_entry(cache_file)
 
             # Close intermediate images inside the with block while we have valid references
-            rgb_img.close()
-            rgb_img = None
+            if rgb_img is not None:
+                rgb_img.close()
+                rgb_img = None
             if transposed_is_copy and transposed_img is not None:
                 transposed_img.close()
                 transposed_img = None
 
-        compressed_size = os.path.getsize(cache_file)
         elapsed_ms = (time.perf_counter() - start_time) * 1000
         compression_ratio = (
             (1 - compressed_size / original_size) * 100 if original_size > 0 else 0
         )
 
         G.logger.info(
-            "[ImageProcessor] Completed %s | %dx%d (%s) -> %dx%d (JPEG) | "
+            "[ImageProcessor] Completed %s | %dx%d (%s) -> %dx%d (%s) | "
             "%.1f KB -> %.1f KB (%.1f%% reduction) | "
             "Resized: %s | Transposed: %s | Overlays: %d | "
             "Quality: %d | Time: %.1f ms | Cache: %d items",
@@ -219,6 +546,7 @@ def resize_and_compress(
             original_mode,
             final_width,
             final_height,
+            fmt,
             original_size / 1024,
             compressed_size / 1024,
             compression_ratio,
@@ -230,7 +558,7 @@ def resize_and_compress(
             G.CACHE_COUNT,
         )
 
-        prune_cache()
+        schedule_prune()
 
         return cache_file
     except Exception as e:
@@ -243,7 +571,13 @@ def resize_and_compress(
         )
         raise e
     finally:
-        # Cleanup in case of exception - close any remaining open images
+        # Cleanup in case of exception - drop any partial temp file and
+        # close any remaining open images
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
         if rgb_img is not None:
             try:
                 rgb_img.close()
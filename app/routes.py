@@ -5,6 +5,9 @@ Flask route handlers for the photo slideshow application.
 # Standard library imports
 import datetime
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from pathlib import Path
 from urllib.parse import quote, urlparse
 
@@ -18,10 +21,26 @@ from flask import (
     session,
 )
 from PIL import UnidentifiedImageError
+from werkzeug.exceptions import NotFound
 
 # Local imports
 from . import globals as G
 
+# Cached icons never change for a given URL; let browsers keep them for a year.
+_ICON_MAX_AGE = 365 * 24 * 60 * 60
+
+# Icon downloads run off the request thread; concurrent requests for the same
+# URL share one in-flight future.
+_ICON_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="icon-fetch")
+_ICON_INFLIGHT: dict[str, Future] = {}
+_ICON_INFLIGHT_LOCK = threading.Lock()
+_ICON_WAIT_SECONDS = 2
+
+# Local icon paths this process has seen on disk. The icon set is small and
+# fixed, so repeat /cache_icon calls skip the makedirs() and exists() probes.
+# Entries are dropped when the file turns out to be gone (cache clear).
+_CACHED_ICONS: set[str] = set()
+
 # Healthcheck API call status cache
 _api_call_status = {
     "config": {"ok": True, "last_error": None},
@@ -95,26 +114,58 @@ def _is_path_under_root(path: str, root: str | None) -> bool:
     return resolved_root == resolved_path or resolved_root in resolved_path.parents
 
 
-def _prepare_random_photo_payload(path: str) -> dict[str, str]:
+def _negotiate_output_format() -> str:
+    """Return the preferred cache format that the client's Accept header lists.
+
+    Wildcards are ignored so only clients that name AVIF/WebP get them;
+    everyone else receives JPEG.
+    """
+    accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+    for fmt in output_format_preference():
+        if fmt == "JPEG" or OUTPUT_FORMATS[fmt][1] in accepted:
+            return fmt
+    return "JPEG"
+
+
+def _send_cached_image(cache_file: str, mime_type: str):
+    """Send a cached image with validators so repeat picks can return 304.
+
+    send_file() derives the ETag from the cache path plus the file's mtime
+    and size, so a re-encoded cache file (new config, cache clear) gets a new
+    ETag even though its path-derived name is unchanged. It fills
+    Last-Modified and Content-Length from the same stat() of the path,
+    answers Range requests, and hands the open file to `wsgi.file_wrapper`
+    (Gunicorn's sendfile(2)) or the path to X-Sendfile when available.
+    """
+    response = send_file(cache_file, mimetype=mime_type, conditional=True)
+    response.vary.add("Accept")
+    return response
+
+
+def _photo_date_fields(path: str) -> dict[str, str]:
+    """Return the overlay date and client age label for `path`."""
+    photo_date = get_cached_photo_date(path)
+    return {
+        "photo_path": path,
+        "age_label": _format_photo_age_label(photo_date),
+        "photo_date": format_date_with_suffix(photo_date) if photo_date else "",
+    }
+
+
+def _prepare_random_photo_payload(path: str, fmt: str = "JPEG") -> dict[str, str]:
     """Prepare random photo metadata and ensure cached image exists."""
-    photo_date = get_photo_date(path)
-    age_label = _format_photo_age_label(photo_date)
+    payload = _photo_date_fields(path)
 
     cache_file = resize_and_compress(
         path,
-        {
-            "top_left": format_date_with_suffix(photo_date) if photo_date else "",
-            "top_right": "",
-        },
+        {"top_left": payload["photo_date"], "top_right": ""},
         50,
+        fmt=fmt,
     )
 
-    return {
-        "cache_file": cache_file,
-        "photo_path": path,
-        "age_label": age_label,
-        "photo_date": format_date_with_suffix(photo_date) if photo_date else "",
-    }
+    payload["cache_file"] = cache_file
+    payload["mime_type"] = mime_type_for(cache_file)
+    return payload
 
 
 @G.app.route("/healthcheck")
@@ -137,18 +188,26 @@ def healthcheck():
 
 
 from .cache_manager import (
+    atomic_write_bytes,
     clear_entire_cache,
     format_date_with_suffix,
+    get_cached_photo_date,
     get_image_metadata,
-    get_photo_date,
     pick_file,
 )
-from .image_utils import resize_and_compress, get_requests_session
+from .image_utils import (
+    OUTPUT_FORMATS,
+    get_requests_session,
+    mime_type_for,
+    output_format_preference,
+    resize_and_compress,
+)
 from .weather_utils import (
     map_openmeteo_code,
     map_metno_symbol,
     get_cached_weather,
     set_cached_weather,
+    weather_fetch_lock,
 )
 from .config_manager import load_config
 
@@ -189,12 +248,13 @@ def index():
 @G.app.route("/random")
 def random_image():
     """
-    Serve a randomly selected and compressed image from the photo root directory.
+    Serve a randomly selected and compressed image from the photo root directory,
+    as AVIF/WebP when the client accepts it and JPEG otherwise.
     Handles cache building state, file selection, image compression, and logging.
     Tracks photo serving statistics per session and returns image with appropriate
     MIME type and dimensions.
     Returns:
-        Flask Response: Compressed image file with JPEG MIME type, or error response.
+        Flask Response: Compressed image file with its MIME type, or error response.
         - 200: Image served successfully
         - 404: No images found in photo root
         - 503: Cache is currently being built
@@ -213,17 +273,20 @@ def random_image():
         client_ip = request.remote_addr
         user_agent = request.headers.get("User-Agent")
 
-        payload = _prepare_random_photo_payload(path)
+        payload = _prepare_random_photo_payload(path, _negotiate_output_format())
         cache_file = payload["cache_file"]
-
-        compressed_size = os.path.getsize(cache_file)
         width, height, mime_type = get_image_metadata(cache_file)
 
+        # send_file() already stat()s the cache file; log its Content-Length
+        # instead of stat()ing it again.
+        response = _send_cached_image(cache_file, mime_type)
+
         G.logger.info(
-            "[Routes] Served buffer from %s | Compressed size: %.1f KB | Dimensions: %sx%s | MIME: %s | "
-            "Client IP: %s | UA: %s | Photo index: %s : Photo served: %s",
+            "[Routes] Served buffer from %s | Compressed size: %.1f KB | "
+            "Dimensions: %sx%s | MIME: %s | Client IP: %s | UA: %s | "
+            "Photo index: %s : Photo served: %s",
             os.path.basename(path),
-            compressed_size / 1024,
+            (response.content_length or 0) / 1024,
             width,
             height,
             mime_type,
@@ -234,7 +297,7 @@ def random_image():
         )
 
         _set_api_status("random", True)
-        return send_file(cache_file, mimetype="image/jpeg")
+        return response
 
     except (OSError, UnidentifiedImageError, ValueError) as e:
         G.logger.error("[Routes] Error serving image: %s", e)
@@ -255,7 +318,10 @@ def api_random_image():
             _set_api_status("random", False, "No images found")
             return jsonify({"error": "No images found"}), 404
 
-        payload = _prepare_random_photo_payload(path)
+        # Only the date is needed here. The image is encoded when the browser
+        # fetches image_url, in the format its image Accept header names;
+        # this fetch() sends */*, so warming a format now would guess wrong.
+        payload = _photo_date_fields(path)
         _set_api_status("random", True)
 
         return jsonify(
@@ -286,9 +352,9 @@ def random_image_by_path():
         return jsonify({"error": "Photo not found"}), 404
 
     try:
-        payload = _prepare_random_photo_payload(path)
+        payload = _prepare_random_photo_payload(path, _negotiate_output_format())
         _set_api_status("random", True)
-        return send_file(payload["cache_file"], mimetype="image/jpeg")
+        return _send_cached_image(payload["cache_file"], payload["mime_type"])
     except (OSError, UnidentifiedImageError, ValueError) as e:
         G.logger.error("[Routes] Error serving image for path %s: %s", path, e)
         _set_api_status("random", False, str(e))
@@ -307,6 +373,7 @@ def clear_cache():
         G.logger.info("[Routes] Manual cache clear requested by client.")
 
         clear_entire_cache()
+        _CACHED_ICONS.clear()
 
         # Optional: reset session counters too
         session["photo_index"] = 0
@@ -321,7 +388,12 @@ def clear_cache():
 
 @G.app.route("/cache_icon", methods=["POST"])
 def cache_icon():
-    """ "Fetch and cache an icon from a given URL."""
+    """Fetch and cache an icon from a given URL.
+
+    Downloads run on a background executor. If one takes longer than
+    `_ICON_WAIT_SECONDS`, the response carries the remote URL and
+    `"pending": true` instead of blocking the worker.
+    """
     data = request.get_json()
     full_url = data["url"]
 
@@ -336,39 +408,74 @@ def cache_icon():
     filename = parts[-1]  # "cloud.svg"
 
     # Build local cache path
-    style_dir = os.path.join(G.CACHE_DIR_ICON, style)
-    os.makedirs(style_dir, exist_ok=True)
-
-    local_path = os.path.join(style_dir, filename)
+    local_path = os.path.join(G.CACHE_DIR_ICON, style, filename)
     relative_path = f"/icons/{style}/{filename}"
 
     # If cached, return immediately
-    if os.path.exists(local_path):
+    if local_path in _CACHED_ICONS or os.path.exists(local_path):
+        _CACHED_ICONS.add(local_path)
         _set_api_status("icon", True)
         return jsonify({"path": relative_path})
 
-    # Download and cache
+    with _ICON_INFLIGHT_LOCK:
+        future = _ICON_INFLIGHT.get(full_url)
+        if future is None:
+            future = _ICON_EXECUTOR.submit(_fetch_icon, full_url, local_path)
+            _ICON_INFLIGHT[full_url] = future
+
+    # Give quick downloads a moment; otherwise let the browser use the remote
+    # URL this time and pick up the local copy on the next weather update.
+    try:
+        fetched = future.result(timeout=_ICON_WAIT_SECONDS)
+    except FutureTimeoutError:
+        return jsonify({"path": full_url, "pending": True})
+
+    if fetched:
+        return jsonify({"path": relative_path})
+    return jsonify({"error": "Failed to fetch icon"}), 500
+
+
+def _fetch_icon(full_url: str, local_path: str) -> bool:
+    """Download an icon into the local cache. Returns True on success."""
     try:
         session_obj = get_requests_session()
         r = session_obj.get(full_url, timeout=60)
         if r.status_code == 200:
-            with open(local_path, "wb") as f:
-                f.write(r.content)
+            # Atomic so a crash never leaves a truncated SVG that the
+            # exists() fast path would then serve forever.
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            atomic_write_bytes(local_path, r.content)
+            _CACHED_ICONS.add(local_path)
             _set_api_status("icon", True)
-            return jsonify({"path": relative_path})
-        else:
-            _set_api_status("icon", False, f"Status code {r.status_code}")
-            return jsonify({"error": "Failed to fetch icon"}), 500
+            return True
+        _set_api_status("icon", False, f"Status code {r.status_code}")
+        return False
     except (OSError, IOError, ValueError) as e:
         G.logger.error("[Icons] Error caching icon from %s: %s", full_url, e)
         _set_api_status("icon", False, str(e))
-        return jsonify({"error": "Failed to fetch icon"}), 500
+        return False
+    finally:
+        with _ICON_INFLIGHT_LOCK:
+            _ICON_INFLIGHT.pop(full_url, None)
 
 
 @G.app.route("/icons/<style>/<filename>")
 def serve_icon(style, filename):
-    """Serve cached icon files."""
-    return send_from_directory(os.path.join(G.CACHE_DIR_ICON, style), filename)
+    """Serve cached icon files.
+
+    An icon URL always maps to the same SVG, so browsers may keep it for a
+    year without revalidating; the ETag still allows 304s after a cache clear.
+    """
+    style_dir = os.path.join(G.CACHE_DIR_ICON, style)
+    try:
+        response = send_from_directory(style_dir, filename, max_age=_ICON_MAX_AGE)
+    except NotFound:
+        # Cleared since /cache_icon saw it; the next call downloads it again.
+        _CACHED_ICONS.discard(os.path.join(style_dir, filename))
+        raise
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @G.app.route("/api/weather/<lat>/<lon>")
@@ -385,20 +492,32 @@ def get_weather(lat: str, lon: str):
     Returns:
         JSON with temp and standardized condition name
     """
-    # Check cache first
+    # Check cache first; on a miss only one request per location fetches,
+    # the others wait for it and then re-check the cache.
     cached = get_cached_weather(lat, lon)
-    if cached:
-        G.logger.info("[Weather] Returning cached weather for %s,%s", lat, lon)
-        _set_api_status("weather", True)
-        return jsonify(cached)
+    if not cached:
+        with weather_fetch_lock(lat, lon):
+            cached = get_cached_weather(lat, lon)
+            if not cached:
+                return _fetch_weather(lat, lon)
 
+    G.logger.info("[Weather] Returning cached weather for %s,%s", lat, lon)
+    _set_api_status("weather", True)
+    return jsonify(cached)
+
+
+def _fetch_weather(lat: str, lon: str):
+    """Fetch and cache weather from met.no, falling back to open-meteo."""
     # Try met.no first
     session_obj = get_requests_session()
     try:
-        url = f"https://api.met.no/weatherapi/locationforecast/2.0/compact?lat={lat}&lon={lon}"
-        headers = {"User-Agent": "PhotomaticWeatherDisplay/1.0"}
+        url = (
+            "https://api.met.no/weatherapi/locationforecast/2.0/compact"
+            f"?lat={lat}&lon={lon}"
+        )
 
-        response = session_obj.get(url, headers=headers, timeout=10)
+        # The shared session sends the User-Agent met.no requires.
+        response = session_obj.get(url, timeout=10)
         response.raise_for_status()
 
         data = response.json()
@@ -420,7 +539,10 @@ def get_weather(lat: str, lon: str):
 
     # Fallback to open-meteo
     try:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true"
+        url = (
+            "https://api.open-meteo.com/v1/forecast"
+            f"?latitude={lat}&longitude={lon}&current_weather=true"
+        )
 
         response = session_obj.get(url, timeout=10)
         response.raise_for_status()
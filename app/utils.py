@@ -4,7 +4,13 @@ import json
 import os
 
 from . import globals as G
-from .cache_manager import prune_cache
+from .cache_manager import (
+    load_cache_index,
+    prune_cache,
+    start_daily_rebuild,
+    start_photo_watcher,
+)
+from .image_utils import log_image_backend
 
 
 def redact_sensitive_values(value):
@@ -53,6 +59,10 @@ def initialize_app_state():
     G.logger.info(
         "Effective startup config:\n%s", json.dumps(redacted_config, indent=2)
     )
+    log_image_backend()
+
+    if G.CACHE_LIMIT_ENABLED:
+        load_cache_index()
 
     if G.CACHE_LIMIT_ENABLED and G.CACHE_COUNT > G.CACHE_LIMIT:
         G.logger.info(
@@ -60,6 +70,12 @@ def initialize_app_state():
         )
         prune_cache()
 
+    cache_cfg = G.CONFIG.get("cache", {})
+    if cache_cfg.get("watch_photos", False):
+        start_photo_watcher(G.PHOTO_ROOT)
+    if cache_cfg.get("background_rebuild", False):
+        start_daily_rebuild(G.PHOTO_ROOT)
+
 
 def run_app():
     """Configure globals and run the Flask application.
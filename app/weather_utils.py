@@ -1,6 +1,9 @@
 """Weather mapping utilities for standardizing different API responses."""
 
+import contextlib
+import threading
 import time
+from collections import OrderedDict
 from . import globals as G
 
 # Open-Meteo WMO weather codes to standardized condition names
@@ -58,75 +61,95 @@ METNO_SYMBOL_MAP = {
 }
 
 
+# OPENMETEO_CODE_MAP flattened to a tuple indexed by code (WMO codes are 0-99)
+_OPENMETEO_CONDITIONS = tuple(OPENMETEO_CODE_MAP.get(i, "cloudy") for i in range(100))
+
+
 def map_openmeteo_code(code: int) -> str:
     """Map Open-Meteo weather code to standardized condition name."""
-    return OPENMETEO_CODE_MAP.get(code, "cloudy")
+    try:
+        return _OPENMETEO_CONDITIONS[code] if code >= 0 else "cloudy"
+    except (IndexError, TypeError):
+        # Codes above 99, or non-int values such as 61.0 or None
+        return OPENMETEO_CODE_MAP.get(code, "cloudy")
 
 
-# Weather cache: stores responses with timestamps
-# Format: { "lat,lon": {"data": {...}, "timestamp": time.time()} }
-_weather_cache = {}
+# Weather cache: (lat, lon) -> (expires_at, data), oldest first. Every entry
+# gets the same TTL, so insertion order is also expiry order and expired
+# entries are always at the front.
+_weather_cache: OrderedDict[tuple[str, str], tuple[float, dict]] = OrderedDict()
 _CACHE_TTL = 30 * 60  # 30 minutes in seconds
 _MAX_CACHE_ENTRIES = 100  # Prevent unbounded memory growth
 
+# Guards _weather_cache and _fetch_locks; request threads share both.
+_cache_lock = threading.Lock()
+# Per-location locks so concurrent misses trigger a single upstream fetch
+_fetch_locks: dict[tuple[str, str], threading.Lock] = {}
+
 
-def _cleanup_expired_cache():
-    """Remove all expired entries from weather cache."""
-    current_time = time.time()
-    expired_keys = [
-        key
-        for key, data in _weather_cache.items()
-        if current_time - data["timestamp"] >= _CACHE_TTL
-    ]
-    for key in expired_keys:
+def _cleanup_expired_cache(now: float) -> None:
+    """Drop expired entries from the front of the weather cache."""
+    removed = 0
+    while _weather_cache:
+        key, (expires_at, _) = next(iter(_weather_cache.items()))
+        if expires_at > now:
+            break
         del _weather_cache[key]
-    if expired_keys:
+        removed += 1
+    if removed:
         G.logger.info(
             "[WeatherCache] Weather cache cleanup: removed %d expired entries",
-            len(expired_keys),
-        )
-
-
-def _enforce_cache_limit():
-    """Enforce maximum cache size by removing oldest entries if needed."""
-    if len(_weather_cache) > _MAX_CACHE_ENTRIES:
-        # Remove oldest 20% of entries
-        entries_to_remove = len(_weather_cache) // 5
-        oldest = sorted(_weather_cache.items(), key=lambda x: x[1]["timestamp"])[
-            :entries_to_remove
-        ]
-        for key, _ in oldest:
-            del _weather_cache[key]
-        G.logger.info(
-            "[WeatherCache] Weather cache limited: removed %d oldest entries",
-            entries_to_remove,
+            removed,
         )
 
 
 def get_cached_weather(lat: str, lon: str) -> dict | None:
     """Get cached weather data if it exists and hasn't expired."""
-    _cleanup_expired_cache()
-    cache_key = f"{lat},{lon}"
-    if cache_key in _weather_cache:
-        cached = _weather_cache[cache_key]
-        if time.time() - cached["timestamp"] < _CACHE_TTL:
-            return cached["data"]
-    return None
+    now = time.monotonic()
+    with _cache_lock:
+        _cleanup_expired_cache(now)
+        entry = _weather_cache.get((lat, lon))
+    return entry[1] if entry is not None else None
 
 
 def set_cached_weather(lat: str, lon: str, data: dict) -> None:
-    """Cache weather data with current timestamp."""
-    _cleanup_expired_cache()
-    _enforce_cache_limit()
-    cache_key = f"{lat},{lon}"
-    _weather_cache[cache_key] = {"data": data, "timestamp": time.time()}
+    """Cache weather data for `_CACHE_TTL` seconds."""
+    now = time.monotonic()
+    with _cache_lock:
+        _cleanup_expired_cache(now)
+        _weather_cache.pop((lat, lon), None)
+        _weather_cache[(lat, lon)] = (now + _CACHE_TTL, data)
+        while len(_weather_cache) > _MAX_CACHE_ENTRIES:
+            _weather_cache.popitem(last=False)
+        cache_size = len(_weather_cache)
     G.logger.info(
-        "[WeatherCache] Added cached weather for %s (cache size: %d)",
-        cache_key,
-        len(_weather_cache),
+        "[WeatherCache] Added cached weather for %s,%s (cache size: %d)",
+        lat,
+        lon,
+        cache_size,
     )
 
 
+@contextlib.contextmanager
+def weather_fetch_lock(lat: str, lon: str):
+    """Serialize upstream fetches for one location.
+
+    Callers re-check `get_cached_weather()` once inside, so requests that
+    waited on another thread's fetch reuse its result.
+    """
+    cache_key = (lat, lon)
+    with _cache_lock:
+        lock = _fetch_locks.setdefault(cache_key, threading.Lock())
+    with lock:
+        try:
+            yield
+        finally:
+            # Waiters keep their own reference; later arrivals hit the cache.
+            with _cache_lock:
+                if _fetch_locks.get(cache_key) is lock:
+                    del _fetch_locks[cache_key]
+
+
 def map_metno_symbol(symbol_code: str) -> str:
     """Map Met.no symbol code to standardized condition name."""
     return METNO_SYMBOL_MAP.get(symbol_code, "cloudy")
@@ -18,6 +18,8 @@ GUNICORN_LOG_LEVEL="${GUNICORN_LOG_LEVEL:-info}"
 
 echo "Starting Gunicorn with workers=$GUNICORN_WORKERS threads=$GUNICORN_THREADS timeout=${GUNICORN_TIMEOUT}s log_level=$GUNICORN_LOG_LEVEL"
 
+# Gunicorn's default sendfile(2) support streams cached photos and icons
+# zero-copy; don't add --no-sendfile here.
 exec gunicorn \
   --workers "$GUNICORN_WORKERS" \
   --threads "$GUNICORN_THREADS" \
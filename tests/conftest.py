@@ -1,12 +1,36 @@
 """Pytest configuration and fixtures.
 
-Ensures the app package is importable from tests.
+Ensures the app package is importable from tests and keeps server-side
+session files out of the configured cache directory.
 """
 
 import os
 import sys
 
+import pytest
+
 # Ensure project root is on sys.path so tests can import the `app` package
 ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if ROOT not in sys.path:
     sys.path.insert(0, ROOT)
+
+from app import globals as G  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def session_store_dir(tmp_path_factory, monkeypatch):
+    """Point the filesystem session backend at a per-test temp dir.
+
+    `app.globals` builds it against the real `CACHE_DIR` at import; tests
+    redirect the other cache dirs themselves. The dir sits outside
+    `tmp_path` so tests that list their tmp dir don't see it.
+    """
+    session_dir = tmp_path_factory.mktemp("sessions")
+    interface = G.app.session_interface
+    if hasattr(interface, "cache"):
+        from cachelib import FileSystemCache
+
+        monkeypatch.setattr(
+            interface, "cache", FileSystemCache(str(session_dir), threshold=500)
+        )
+    return session_dir
@@ -5,11 +5,14 @@ Validates HTTP endpoints including the /random image serving route.
 
 import datetime
 import os
+import threading
+import time
 
 from PIL import Image
 
 import app.routes as routes
 from app import cache_manager
+from app import weather_utils
 from app import globals as G
 
 
@@ -59,7 +62,7 @@ def test_api_random_route_returns_photo_age_payload(tmp_path, monkeypatch):
 
     captured = {}
 
-    def fake_resize_and_compress(path, overlays=None, quality=75):
+    def fake_resize_and_compress(path, overlays=None, quality=75, fmt="JPEG"):
         captured["path"] = path
         captured["overlays"] = overlays or {}
         captured["quality"] = quality
@@ -69,7 +72,7 @@ def test_api_random_route_returns_photo_age_payload(tmp_path, monkeypatch):
     ten_years_ago = datetime.date(today.year - 10, today.month, today.day)
 
     monkeypatch.setattr(routes, "pick_file", lambda _base_dir: str(img_path))
-    monkeypatch.setattr(routes, "get_photo_date", lambda _path: ten_years_ago)
+    monkeypatch.setattr(routes, "get_cached_photo_date", lambda _path: ten_years_ago)
     monkeypatch.setattr(routes, "resize_and_compress", fake_resize_and_compress)
 
     G.PHOTO_ROOT = str(photos)
@@ -81,10 +84,272 @@ def test_api_random_route_returns_photo_age_payload(tmp_path, monkeypatch):
     assert data["age_label"] == "Today, 10 years ago"
     assert data["photo_path"] == str(img_path)
     assert data["image_url"].startswith("/random_image?path=")
+    # The image is only encoded once the browser fetches image_url.
+    assert captured == {}
+
+    assert client.get(data["image_url"]).status_code == 200
     # Age label now renders on the client, so top_right overlay should be empty.
     assert captured["overlays"]["top_right"] == ""
 
 
+def test_random_image_negotiates_format_from_accept(tmp_path, monkeypatch):
+    """/random_image should pick WebP only when the client explicitly accepts it."""
+    photos = tmp_path / "photos"
+    photos.mkdir()
+    img_path = photos / "negotiate.jpg"
+    Image.new("RGB", (40, 30), (10, 20, 30)).save(str(img_path), format="JPEG")
+    G.PHOTO_ROOT = str(photos)
+
+    requested = []
+
+    def fake_resize_and_compress(path, overlays=None, quality=75, fmt="JPEG"):
+        requested.append(fmt)
+        return str(img_path)
+
+    monkeypatch.setattr(routes, "resize_and_compress", fake_resize_and_compress)
+    monkeypatch.setattr(routes, "output_format_preference", lambda: ["WEBP", "JPEG"])
+
+    client = G.app.test_client()
+    resp = client.get(
+        f"/random_image?path={img_path}", headers={"Accept": "image/webp,*/*"}
+    )
+    assert resp.status_code == 200
+    assert "Accept" in resp.headers.get("Vary", "")
+
+    client.get(f"/random_image?path={img_path}", headers={"Accept": "*/*"})
+
+    assert requested == ["WEBP", "JPEG"]
+
+
+def test_random_image_returns_304_for_matching_etag(tmp_path, monkeypatch):
+    """A repeat request carrying the cache file ETag should get 304 Not Modified."""
+    photos = tmp_path / "photos"
+    photos.mkdir()
+    img_path = photos / "etag.jpg"
+    Image.new("RGB", (40, 30), (10, 20, 30)).save(str(img_path), format="JPEG")
+    G.PHOTO_ROOT = str(photos)
+
+    monkeypatch.setattr(
+        routes, "resize_and_compress", lambda path, *args, **kwargs: str(img_path)
+    )
+
+    client = G.app.test_client()
+    first = client.get(f"/random_image?path={img_path}")
+    etag = first.headers.get("ETag")
+
+    assert first.status_code == 200
+    assert etag
+    assert first.headers.get("Last-Modified")
+
+    second = client.get(
+        f"/random_image?path={img_path}", headers={"If-None-Match": etag}
+    )
+    assert second.status_code == 304
+    assert second.data == b""
+
+    # A re-encode keeps the cache filename but must not match the old ETag.
+    Image.new("RGB", (40, 30), (200, 20, 30)).save(str(img_path), format="JPEG")
+    os.utime(img_path, ns=(1, 1))
+    third = client.get(
+        f"/random_image?path={img_path}", headers={"If-None-Match": etag}
+    )
+    assert third.status_code == 200
+    assert third.headers.get("ETag") != etag
+
+
+def test_random_image_answers_range_requests(tmp_path, monkeypatch):
+    """Cached images keep send_file's partial-content support."""
+    photos = tmp_path / "photos"
+    photos.mkdir()
+    img_path = photos / "range.jpg"
+    Image.new("RGB", (40, 30), (10, 20, 30)).save(str(img_path), format="JPEG")
+    G.PHOTO_ROOT = str(photos)
+
+    monkeypatch.setattr(
+        routes, "resize_and_compress", lambda path, *args, **kwargs: str(img_path)
+    )
+
+    client = G.app.test_client()
+    resp = client.get(f"/random_image?path={img_path}", headers={"Range": "bytes=0-9"})
+
+    assert resp.status_code == 206
+    assert resp.data == img_path.read_bytes()[:10]
+    assert resp.headers["Content-Range"] == f"bytes 0-9/{img_path.stat().st_size}"
+
+
+def test_send_cached_image_uses_wsgi_file_wrapper(tmp_path):
+    """Servers with wsgi.file_wrapper get the open file to sendfile()."""
+    cache_file = tmp_path / "abc.jpg"
+    cache_file.write_bytes(b"zero-copy")
+    wrapped = []
+
+    def file_wrapper(file, block_size=8192):
+        wrapped.append(file)
+        return iter(lambda: file.read(block_size), b"")
+
+    with G.app.test_request_context(
+        "/random", environ_base={"wsgi.file_wrapper": file_wrapper}
+    ):
+        resp = routes._send_cached_image(str(cache_file), "image/jpeg")
+        assert resp.direct_passthrough
+        assert b"".join(resp.response) == b"zero-copy"
+        resp.close()
+
+    assert len(wrapped) == 1
+
+
+def test_serve_icon_sets_immutable_cache_headers(tmp_path):
+    """Cached icons should be served with long-lived immutable caching and an ETag."""
+    original_icon_dir = G.CACHE_DIR_ICON
+    G.CACHE_DIR_ICON = str(tmp_path / "icons")
+    style_dir = tmp_path / "icons" / "lucide"
+    style_dir.mkdir(parents=True)
+    (style_dir / "sun.svg").write_text("<svg></svg>", encoding="utf-8")
+
+    try:
+        resp = G.app.test_client().get("/icons/lucide/sun.svg")
+    finally:
+        G.CACHE_DIR_ICON = original_icon_dir
+
+    assert resp.status_code == 200
+    assert resp.cache_control.max_age == 31536000
+    assert resp.cache_control.public
+    assert resp.cache_control.immutable
+    assert resp.headers.get("ETag")
+
+
+class _FakeIconSession:
+    """Stand-in for the shared requests session used by /cache_icon."""
+
+    def __init__(self, release=None):
+        self.release = release
+
+    def get(self, _url, timeout=None):
+        if self.release is not None:
+            self.release.wait(5)
+        response = type("Response", (), {})()
+        response.status_code = 200
+        response.content = b"<svg></svg>"
+        return response
+
+
+def test_cache_icon_downloads_in_background(tmp_path, monkeypatch):
+    """/cache_icon should return the local path once a quick download finishes."""
+    monkeypatch.setattr(G, "CACHE_DIR_ICON", str(tmp_path / "icons"))
+    monkeypatch.setattr(routes, "get_requests_session", lambda: _FakeIconSession())
+
+    client = G.app.test_client()
+    resp = client.post(
+        "/cache_icon", json={"url": "https://icons.example/lucide/sun.svg"}
+    )
+
+    assert resp.get_json() == {"path": "/icons/lucide/sun.svg"}
+    assert (tmp_path / "icons" / "lucide" / "sun.svg").read_bytes() == b"<svg></svg>"
+
+
+def test_cache_icon_remembers_cached_icons(tmp_path, monkeypatch):
+    """Known icons skip the disk probe until serving shows they are gone."""
+    monkeypatch.setattr(G, "CACHE_DIR_ICON", str(tmp_path / "icons"))
+    monkeypatch.setattr(routes, "_CACHED_ICONS", set())
+    monkeypatch.setattr(routes, "get_requests_session", lambda: _FakeIconSession())
+    url = "https://icons.example/lucide/moon.svg"
+    icon_file = tmp_path / "icons" / "lucide" / "moon.svg"
+
+    client = G.app.test_client()
+    assert client.post("/cache_icon", json={"url": url}).get_json() == {
+        "path": "/icons/lucide/moon.svg"
+    }
+    assert str(icon_file) in routes._CACHED_ICONS
+
+    def fail_exists(_path):
+        raise AssertionError("known icons should not be stat()ed")
+
+    with monkeypatch.context() as m:
+        m.setattr(routes.os.path, "exists", fail_exists)
+        resp = client.post("/cache_icon", json={"url": url})
+    assert resp.get_json() == {"path": "/icons/lucide/moon.svg"}
+
+    icon_file.unlink()
+    assert client.get("/icons/lucide/moon.svg").status_code == 404
+    assert str(icon_file) not in routes._CACHED_ICONS
+
+
+def test_cache_icon_returns_remote_url_while_pending(tmp_path, monkeypatch):
+    """A slow download should not block the request; the remote URL is returned."""
+    release = threading.Event()
+    monkeypatch.setattr(G, "CACHE_DIR_ICON", str(tmp_path / "icons"))
+    monkeypatch.setattr(routes, "_ICON_WAIT_SECONDS", 0.01)
+    monkeypatch.setattr(
+        routes, "get_requests_session", lambda: _FakeIconSession(release)
+    )
+
+    url = "https://icons.example/lucide/rain.svg"
+    client = G.app.test_client()
+    try:
+        resp = client.post("/cache_icon", json={"url": url})
+        assert resp.get_json() == {"path": url, "pending": True}
+        future = routes._ICON_INFLIGHT[url]
+    finally:
+        release.set()
+
+    assert future.result(timeout=5) is True
+    assert (tmp_path / "icons" / "lucide" / "rain.svg").exists()
+
+
+class _FakeWeatherSession:
+    """Counts upstream weather calls and answers like met.no."""
+
+    def __init__(self, release=None):
+        self.calls = 0
+        self.release = release
+
+    def get(self, url, timeout=None):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        response = type("Resp", (), {})()
+        response.raise_for_status = lambda: None
+        response.json = lambda: {
+            "properties": {
+                "timeseries": [
+                    {
+                        "data": {
+                            "instant": {"details": {"air_temperature": 21.5}},
+                            "next_1_hours": {"summary": {"symbol_code": "fog"}},
+                        }
+                    }
+                ]
+            }
+        }
+        return response
+
+
+def test_get_weather_fetches_once_for_concurrent_misses(monkeypatch):
+    """Concurrent requests for an uncached location share one upstream fetch."""
+    release = threading.Event()
+    fake = _FakeWeatherSession(release)
+    monkeypatch.setattr(routes, "get_requests_session", lambda: fake)
+    monkeypatch.setattr(
+        weather_utils, "_weather_cache", weather_utils.OrderedDict()
+    )
+
+    results = []
+
+    def fetch():
+        with G.app.test_client() as client:
+            results.append(client.get("/api/weather/59.9/10.7").get_json())
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for t in threads:
+        t.start()
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert fake.calls == 1
+    assert results == [{"temp": 21.5, "condition": "fog"}] * 4
+
+
 def test_random_image_by_path_rejects_invalid_path(tmp_path):
     """/random_image should reject paths outside the configured photo root."""
     photos = tmp_path / "photos"
@@ -99,3 +364,35 @@ def test_random_image_by_path_rejects_invalid_path(tmp_path):
     resp = client.get(f"/random_image?path={outside}")
 
     assert resp.status_code == 400
+
+
+def test_random_recovers_after_clear_cache_while_rebuild_thread_runs(
+    tmp_path, monkeypatch
+):
+    """/clear_cache must not leave /random empty until the next daily rebuild."""
+    photos = tmp_path / "photos_cleared"
+    photos.mkdir()
+    Image.new("RGB", (40, 30), (10, 20, 30)).save(
+        str(photos / "20190101_kept.jpg"), format="JPEG"
+    )
+    G.app.instance_path = str(tmp_path / "instance")
+    G.CACHE_DIR = os.path.join(G.app.instance_path, "cache")
+    G.CACHE_DIR_PHOTO = os.path.join(G.CACHE_DIR, "photos")
+    os.makedirs(G.CACHE_DIR_PHOTO, exist_ok=True)
+    monkeypatch.setattr(G, "CACHE_DIR_ICON", os.path.join(G.CACHE_DIR, "icons"))
+    os.makedirs(G.CACHE_DIR_ICON)
+    monkeypatch.setattr(G, "PHOTO_ROOT", str(photos))
+    monkeypatch.setitem(cache_manager._REBUILD_STATE, "thread", None)
+    monkeypatch.setattr(cache_manager, "seconds_until_next_rebuild", lambda: 3600)
+
+    cache_manager.start_daily_rebuild(str(photos))
+    deadline = time.monotonic() + 5
+    while G.BUILDING_CACHE and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache_manager.daily_rebuild_running()
+
+    client = G.app.test_client()
+    assert client.get("/random").status_code == 200
+    assert client.get("/clear_cache").status_code == 200
+    assert cache_manager.daily_rebuild_running()
+    assert client.get("/random").status_code == 200
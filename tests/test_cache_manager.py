@@ -4,6 +4,12 @@ Covers cache building, pruning, metadata handling, and SAME_DAY_KEYS operations.
 """
 
 import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import pytest
 from PIL import Image
 
 from app import cache_manager
@@ -125,6 +131,36 @@ def test_prune_orphaned_metadata_removes_stale_json(tmp_path):
     assert os.path.exists(valid_img)
 
 
+def test_atomic_write_bytes_leaves_no_partial_file(tmp_path, monkeypatch):
+    """A failed write should keep the old file and clean up its temp file."""
+    target = tmp_path / "icon.svg"
+    target.write_bytes(b"old")
+
+    def fail_replace(_src, _dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(cache_manager.os, "replace", fail_replace)
+    with pytest.raises(OSError):
+        cache_manager.atomic_write_bytes(str(target), b"new")
+
+    assert target.read_bytes() == b"old"
+    assert os.listdir(tmp_path) == ["icon.svg"]
+
+
+def test_get_image_metadata_is_memoized_until_forgotten(tmp_path):
+    """Sidecar metadata should be read once and dropped from the memo on prune."""
+    cache_file = str(tmp_path / "memo.jpg")
+    make_image(cache_file)
+    cache_manager.write_image_metadata(cache_file, 640, 480, "image/jpeg")
+    os.remove(cache_file + ".json")
+
+    # Served from the memo even though the sidecar is gone.
+    assert cache_manager.get_image_metadata(cache_file) == (640, 480, "image/jpeg")
+
+    cache_manager.forget_image_metadata(cache_file)
+    assert cache_manager.get_image_metadata(cache_file) == (100, 80, "image/jpeg")
+
+
 def test_prune_cache_removes_metadata_with_image(tmp_path):
     """Test that metadata files are removed when their images are pruned."""
     _, cache_dir_photo = setup_cache_dirs(tmp_path)
@@ -210,6 +246,22 @@ def test_prune_cache_skips_when_limit_disabled(tmp_path):
         G.CACHE_LIMIT = original_limit
 
 
+def test_touch_cache_entry_skips_lru_when_limit_disabled(tmp_path, monkeypatch):
+    """Cache hits neither scan the directory nor lock when nothing is pruned."""
+    _, cache_dir_photo = setup_cache_dirs(tmp_path)
+    monkeypatch.setattr(G, "CACHE_LIMIT_ENABLED", False)
+    monkeypatch.setitem(cache_manager._CACHE_LRU, "dir", None)
+
+    def fail(*_args):
+        raise AssertionError("touch_cache_entry should return early")
+
+    monkeypatch.setattr(cache_manager, "_scan_cache_dir", fail)
+    monkeypatch.setattr(G, "get_cache_lock", fail)
+
+    cache_manager.touch_cache_entry(os.path.join(cache_dir_photo, "hit.jpg"))
+    assert cache_manager._CACHE_LRU["dir"] is None
+
+
 def test_pick_file_interleaves_non_same_day_when_cycle_hit(tmp_path):
     """After SAME_DAY_CYCLE same-day picks, a non-same-day photo should be served."""
     photos = tmp_path / "photos_mix"
@@ -285,3 +337,611 @@ def test_pick_file_does_not_loop_same_day_after_exhaustion(tmp_path):
             assert fourth is not None and os.path.basename(fourth) == other.name
     finally:
         G.SAME_DAY_CYCLE = original_cycle
+
+
+def test_pick_file_leaves_unchanged_session_unmodified(tmp_path):
+    """Picks that do not move the slideshow state should not re-sign the cookie."""
+    photos = tmp_path / "photos_session"
+    photos.mkdir(parents=True, exist_ok=True)
+    make_image(str(photos / "20190101_other.jpg"))
+
+    setup_cache_dirs(tmp_path)
+    cache_manager.build_cache(str(photos))
+
+    with G.app.test_request_context("/"):
+        first = cache_manager.pick_file(str(photos))
+        assert first is not None
+        assert cache_manager.session.modified
+
+        cache_manager.session.modified = False
+        second = cache_manager.pick_file(str(photos))
+        assert second == first
+        assert not cache_manager.session.modified
+
+
+def test_seconds_until_next_rebuild_targets_just_after_midnight():
+    """The scheduler should wake a few seconds into the next day."""
+    now = cache_manager.datetime.datetime(2024, 3, 1, 23, 59, 0)
+
+    assert cache_manager.seconds_until_next_rebuild(now) == 60 + 5
+
+
+def test_start_daily_rebuild_builds_in_background(tmp_path, monkeypatch):
+    """The background thread should build once and pick_file should not rebuild."""
+    cache_dir, _ = setup_cache_dirs(tmp_path)
+    for name in ("cache_all.txt", "cache_same_day.txt"):
+        cache_manager._write_line_file(os.path.join(cache_dir, name), [])
+    built = threading.Event()
+    calls = []
+
+    def fake_build(base_dir, paths=None):
+        calls.append(base_dir)
+        G.BUILDING_CACHE = False
+        built.set()
+
+    monkeypatch.setitem(cache_manager._REBUILD_STATE, "thread", None)
+    monkeypatch.setattr(cache_manager, "build_cache", fake_build)
+
+    thread = cache_manager.start_daily_rebuild("/photos")
+    assert built.wait(5)
+    assert cache_manager.start_daily_rebuild("/photos") is thread
+    assert cache_manager.daily_rebuild_running()
+
+    monkeypatch.setattr(G, "CACHE_DATE", None)
+    with G.app.test_request_context("/"):
+        cache_manager.pick_file("/photos")
+
+    assert calls == ["/photos"]
+
+
+def test_build_cache_survives_date_cache_locked_by_another_process(
+    tmp_path, monkeypatch
+):
+    """A date cache held by another writer should not fail the build."""
+    photos = tmp_path / "photos_locked"
+    photos.mkdir()
+    undated = photos / "undated.jpg"
+    make_image(str(undated))
+    os.utime(undated, (946684800, 946684800))  # 2000-01-01 UTC
+
+    cache_dir, _ = setup_cache_dirs(tmp_path)
+    monkeypatch.setattr(cache_manager, "_DATE_CACHE_TIMEOUT", 0.05)
+    cache_manager.open_date_cache().close()
+
+    other = sqlite3.connect(os.path.join(cache_dir, G.DATE_CACHE_FILENAME))
+    try:
+        other.execute("BEGIN IMMEDIATE")
+        cache_manager.build_cache(str(photos))
+    finally:
+        other.rollback()
+        other.close()
+
+    all_file = os.path.join(cache_dir, "cache_all.txt")
+    with open(all_file, encoding="utf-8") as f:
+        assert f.read().splitlines() == [str(undated)]
+    assert G.BUILDING_CACHE is False
+
+
+def test_build_cache_writes_line_offset_index(tmp_path):
+    """The .idx written by build_cache should address every cache line directly."""
+    photos = Path(str(tmp_path).replace("_cache_", "_photos_")) / "photos_idx"
+    photos.mkdir(parents=True, exist_ok=True)
+    today = cache_manager.datetime.date.today()
+    names = [
+        f"{(today - cache_manager.datetime.timedelta(days=d)).strftime('%Y%m%d')}_{n}.jpg"
+        for d, n in ((40, "a"), (80, "bé"), (120, "c"))
+    ]
+    for name in names:
+        make_image(str(photos / name))
+
+    setup_cache_dirs(tmp_path)
+    cache_manager.build_cache(str(photos))
+
+    all_file = os.path.join(G.CACHE_DIR, "cache_all.txt")
+    all_idx = os.path.join(G.CACHE_DIR, "cache_all.idx")
+
+    assert cache_manager.count_lines_idx(all_idx) == len(names)
+    assert cache_manager.count_lines(all_file) == len(names)
+    for i in range(cache_manager.count_lines(all_file)):
+        assert cache_manager.get_line_idx(
+            all_file, all_idx, i
+        ) == cache_manager.get_line(all_file, i)
+
+    assert cache_manager.get_line_idx(all_file, all_idx, len(names)) is None
+    assert cache_manager.count_lines_idx(str(tmp_path / "missing.idx")) == 0
+
+
+def test_get_line_idx_sees_rewritten_cache_file(tmp_path):
+    """Mapped cache files should be re-mapped after a rebuild replaces them."""
+    filepath = str(tmp_path / "lines.txt")
+    idx_path = cache_manager._index_path(filepath)
+
+    cache_manager._write_line_file(filepath, ["/a.jpg", "/b.jpg"])
+    assert cache_manager.get_line_idx(filepath, idx_path, 1) == "/b.jpg"
+
+    cache_manager._write_line_file(filepath, ["/c.jpg"])
+    assert cache_manager.get_line_idx(filepath, idx_path, 0) == "/c.jpg"
+    assert cache_manager.get_line_idx(filepath, idx_path, 1) is None
+
+    cache_manager._write_line_file(filepath, [])
+    assert cache_manager.get_line_idx(filepath, idx_path, 0) is None
+
+
+def test_get_line_idx_rejects_index_from_another_text_file(tmp_path, monkeypatch):
+    """A text file paired with an index written for another one is not read."""
+    monkeypatch.setattr(cache_manager, "_LINE_PAIR_RETRY_DELAY", 0)
+    filepath = str(tmp_path / "pair.txt")
+    idx_path = cache_manager._index_path(filepath)
+
+    cache_manager._write_line_file(filepath, ["/first/a.jpg", "/first/b.jpg"])
+    with open(idx_path, "rb") as f:
+        old_index = f.read()
+    # Simulate a reader landing between the text and index renames.
+    cache_manager.atomic_write_bytes(filepath, b"/x.jpg\n/second/longer.jpg\n")
+    cache_manager.atomic_write_bytes(idx_path, old_index)
+
+    assert cache_manager.get_line_idx(filepath, idx_path, 1) is None
+
+    cache_manager._write_line_file(filepath, ["/x.jpg", "/second/longer.jpg"])
+    assert cache_manager.get_line_idx(filepath, idx_path, 1) == "/second/longer.jpg"
+
+
+def test_build_cache_reuses_persisted_photo_dates(tmp_path, monkeypatch):
+    """A second build should answer unchanged files from the date cache."""
+    photos = Path(str(tmp_path).replace("_cache_", "_photos_")) / "photos_dates"
+    photos.mkdir(parents=True, exist_ok=True)
+    make_image(str(photos / "undated_a.jpg"))
+    make_image(str(photos / "undated_b.jpg"))
+
+    setup_cache_dirs(tmp_path)
+    cache_manager.build_cache(str(photos))
+    assert os.path.exists(os.path.join(G.CACHE_DIR, G.DATE_CACHE_FILENAME))
+
+    calls = []
+    original = cache_manager.get_photo_date
+
+    def counting_get_photo_date(path):
+        calls.append(path)
+        return original(path)
+
+    monkeypatch.setattr(cache_manager, "get_photo_date", counting_get_photo_date)
+    cache_manager.build_cache(str(photos))
+    assert calls == []
+
+    # Touching a file invalidates its cached row only.
+    changed = photos / "undated_a.jpg"
+    st = os.stat(changed)
+    os.utime(changed, (st.st_atime, st.st_mtime - 86400))
+    cache_manager.build_cache(str(photos))
+    assert calls == [str(changed)]
+
+
+def test_get_photo_date_reads_jpeg_exif_without_pillow(tmp_path, monkeypatch):
+    """JPEG EXIF dates come from the header scan, preferring DateTimeOriginal."""
+    exif = Image.Exif()
+    exif[0x0132] = "2001:02:03 04:05:06"
+    exif.get_ifd(0x8769)[0x9003] = "1999:12:31 01:02:03"
+    img_path = tmp_path / "undated.jpg"
+    Image.new("RGB", (10, 10)).save(str(img_path), format="JPEG", exif=exif)
+
+    def fail_open(*_args, **_kwargs):
+        raise AssertionError("Image.open should not be used for JPEG EXIF")
+
+    monkeypatch.setattr(cache_manager.Image, "open", fail_open)
+
+    assert cache_manager.get_photo_date(str(img_path)) == (
+        cache_manager.datetime.date(1999, 12, 31)
+    )
+
+
+def test_parse_date_from_filename_patterns():
+    """Both filename patterns parse; invalid candidates fall through to the next."""
+    parse = cache_manager.parse_date_from_filename
+    date = cache_manager.datetime.date
+
+    assert parse("IMG_20190704_101112.jpg") == date(2019, 7, 4)
+    assert parse("holiday 2018-12-25.png") == date(2018, 12, 25)
+    assert parse("IMG_99999999_2020-02-29.jpg") == date(2020, 2, 29)
+    assert parse("2019-0704.jpg") is None
+    assert parse("no-date.jpg") is None
+
+
+def test_get_photo_date_reads_exif_ifd_date_via_pillow(tmp_path):
+    """Non-JPEG/HEIC files should still find DateTimeOriginal in the Exif IFD."""
+    exif = Image.Exif()
+    exif[0x0132] = "2001:02:03 04:05:06"
+    exif.get_ifd(0x8769)[0x9003] = "1999:12:31 01:02:03"
+    img_path = tmp_path / "undated.png"
+    Image.new("RGB", (10, 10)).save(str(img_path), format="PNG", exif=exif)
+
+    assert cache_manager.get_photo_date(str(img_path)) == (
+        cache_manager.datetime.date(1999, 12, 31)
+    )
+
+
+def test_get_photo_date_reads_heic_exif_without_pillow(tmp_path, monkeypatch):
+    """HEIC EXIF dates come from the container metadata, not a Pillow decode."""
+    exif = Image.Exif()
+    exif[0x0132] = "2001:02:03 04:05:06"
+    exif.get_ifd(0x8769)[0x9003] = "1999:12:31 01:02:03"
+    img_path = tmp_path / "undated.heic"
+    assert cache_manager.ensure_heif_opener(str(img_path))
+    Image.new("RGB", (16, 16)).save(str(img_path), format="HEIF", exif=exif.tobytes())
+
+    def fail_open(*_args, **_kwargs):
+        raise AssertionError("Image.open should not be used for HEIC EXIF")
+
+    monkeypatch.setattr(cache_manager.Image, "open", fail_open)
+
+    assert cache_manager.get_photo_date(str(img_path)) == (
+        cache_manager.datetime.date(1999, 12, 31)
+    )
+
+
+def test_prune_cache_evicts_least_recently_used(tmp_path):
+    """A cache hit should protect an old entry from the next eviction."""
+    _, cache_dir_photo = setup_cache_dirs(tmp_path)
+
+    original_limit_enabled = G.CACHE_LIMIT_ENABLED
+    original_limit = G.CACHE_LIMIT
+    try:
+        G.CACHE_LIMIT_ENABLED = True
+        G.CACHE_LIMIT = 2
+        G.SAME_DAY_KEYS = set()
+
+        paths = []
+        for i in range(3):
+            img_path = os.path.join(cache_dir_photo, f"lru{i}.jpg")
+            make_image(img_path)
+            os.utime(img_path, (1000 + i, 1000 + i))
+            paths.append(img_path)
+
+        cache_manager.load_cache_index()
+        assert G.CACHE_COUNT == 3
+
+        # Oldest file is used again, so the middle one becomes the LRU victim.
+        cache_manager.touch_cache_entry(paths[0])
+        cache_manager.prune_cache()
+
+        assert os.path.exists(paths[0])
+        assert not os.path.exists(paths[1])
+        assert os.path.exists(paths[2])
+        assert G.CACHE_COUNT == 2
+    finally:
+        G.CACHE_LIMIT_ENABLED = original_limit_enabled
+        G.CACHE_LIMIT = original_limit
+
+
+def test_schedule_prune_waits_for_a_batch_then_prunes_in_background(
+    tmp_path, monkeypatch
+):
+    """Pruning should be deferred until a batch of entries is over the limit."""
+    _, cache_dir_photo = setup_cache_dirs(tmp_path)
+    monkeypatch.setattr(G, "CACHE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(G, "CACHE_LIMIT", 2)
+    monkeypatch.setattr(G, "SAME_DAY_KEYS", set())
+    monkeypatch.setattr(cache_manager, "_PRUNE_BATCH", 4)
+
+    for i in range(5):
+        img_path = os.path.join(cache_dir_photo, f"batch{i}.jpg")
+        make_image(img_path)
+        os.utime(img_path, (1000 + i, 1000 + i))
+    cache_manager.load_cache_index()
+
+    cache_manager.schedule_prune()
+    assert cache_manager._PRUNE_STATE["scheduled"] is False
+    assert G.CACHE_COUNT == 5
+
+    extra = os.path.join(cache_dir_photo, "batch5.jpg")
+    make_image(extra)
+    cache_manager.touch_cache_entry(extra)
+    cache_manager.schedule_prune()
+    # The single worker runs jobs in order, so this waits for the prune.
+    cache_manager._PRUNE_EXECUTOR.submit(lambda: None).result(timeout=5)
+
+    assert G.CACHE_COUNT == 2
+    assert sorted(os.listdir(cache_dir_photo)) == ["batch4.jpg", "batch5.jpg"]
+    assert cache_manager._PRUNE_STATE["scheduled"] is False
+
+
+def test_format_date_with_suffix_is_memoized():
+    """Ordinal labels should be correct and computed once per date."""
+    date = cache_manager.datetime.date
+    cache_manager.format_date_with_suffix.cache_clear()
+
+    assert cache_manager.format_date_with_suffix(date(2020, 1, 1)) == "1st Jan 2020"
+    assert cache_manager.format_date_with_suffix(date(2021, 3, 12)) == "12th Mar 2021"
+    assert cache_manager.format_date_with_suffix(date(2022, 5, 23)) == "23rd May 2022"
+    assert cache_manager.format_date_with_suffix(date(2020, 1, 1)) == "1st Jan 2020"
+
+    info = cache_manager.format_date_with_suffix.cache_info()
+    assert (info.hits, info.misses) == (1, 3)
+
+
+def test_get_cached_photo_date_rereads_edited_photos(tmp_path, monkeypatch):
+    """Memoized dates follow the photo's mtime and are dropped on cache clear."""
+    setup_cache_dirs(tmp_path)
+    monkeypatch.setattr(G, "CACHE_DIR_ICON", os.path.join(G.CACHE_DIR, "icons"))
+    os.makedirs(G.CACHE_DIR_ICON)
+    photo = tmp_path / "undated.jpg"
+    make_image(str(photo))
+    cache_manager._photo_date_memo.cache_clear()
+
+    os.utime(photo, (1_500_000_000, 1_500_000_000))
+    first = cache_manager.get_cached_photo_date(str(photo))
+    assert cache_manager.get_cached_photo_date(str(photo)) == first
+
+    os.utime(photo, (1_600_000_000, 1_600_000_000))
+    assert cache_manager.get_cached_photo_date(str(photo)) == (
+        cache_manager.datetime.date.fromtimestamp(1_600_000_000)
+    )
+    assert cache_manager._photo_date_memo.cache_info().misses == 2
+
+    cache_manager.clear_entire_cache()
+    assert cache_manager._photo_date_memo.cache_info().currsize == 0
+
+
+def test_prune_cache_counts_files_written_by_other_workers(tmp_path, monkeypatch):
+    """The limit should apply to the shared directory, not one worker's LRU."""
+    _, cache_dir_photo = setup_cache_dirs(tmp_path)
+    monkeypatch.setattr(G, "CACHE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(G, "CACHE_LIMIT", 2)
+    monkeypatch.setattr(G, "SAME_DAY_KEYS", set())
+
+    for i in range(3):
+        img_path = os.path.join(cache_dir_photo, f"mine{i}.jpg")
+        make_image(img_path)
+        os.utime(img_path, (1000 + i, 1000 + i))
+    cache_manager.load_cache_index()
+
+    # Another worker adds newer files this process's LRU never heard about.
+    for i in range(2):
+        img_path = os.path.join(cache_dir_photo, f"theirs{i}.jpg")
+        make_image(img_path)
+        os.utime(img_path, (2000 + i, 2000 + i))
+
+    cache_manager.prune_cache()
+
+    assert sorted(os.listdir(cache_dir_photo)) == ["theirs0.jpg", "theirs1.jpg"]
+    assert G.CACHE_COUNT == 2
+
+
+def test_iter_image_paths_recurses_and_skips_ignored_dirs(tmp_path):
+    """Nested photos are found; thumbnail/cache folders and non-images are not."""
+    (tmp_path / "2020" / "summer").mkdir(parents=True)
+    (tmp_path / "@__thumb").mkdir()
+    (tmp_path / "Thumbnails").mkdir()
+    make_image(str(tmp_path / "top.JPG"))
+    make_image(str(tmp_path / "2020" / "summer" / "beach.jpg"))
+    make_image(str(tmp_path / "@__thumb" / "skip.jpg"))
+    make_image(str(tmp_path / "Thumbnails" / "skip.jpg"))
+    (tmp_path / "notes.txt").write_text("not a photo", encoding="utf-8")
+
+    found = sorted(cache_manager.iter_image_paths(str(tmp_path)))
+
+    assert found == sorted(
+        [
+            os.path.join(str(tmp_path), "top.JPG"),
+            os.path.join(str(tmp_path), "2020", "summer", "beach.jpg"),
+        ]
+    )
+
+
+def test_add_and_remove_cached_photo_update_lists_in_place(tmp_path, monkeypatch):
+    """Watcher updates should append new photos and hide deleted ones."""
+    photos = tmp_path / "photos_watch"
+    photos.mkdir()
+    old = photos / "20190101_old.jpg"
+    make_image(str(old))
+
+    setup_cache_dirs(tmp_path)
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "deleted", set())
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "added", {})
+    cache_manager.build_cache(str(photos))
+    all_file = os.path.join(G.CACHE_DIR, "cache_all.txt")
+    all_idx = cache_manager._index_path(all_file)
+    assert cache_manager.get_line_idx(all_file, all_idx, 0) == str(old)
+
+    new = photos / "20180505_new.jpg"
+    make_image(str(new))
+    assert cache_manager.add_cached_photo(str(new)) is True
+    assert cache_manager.add_cached_photo(str(new)) is False
+    assert cache_manager.count_lines_idx(all_idx) == 2
+    assert cache_manager.get_line_idx(all_file, all_idx, 1) == str(new)
+
+    cache_manager.remove_cached_photo(str(old))
+    assert cache_manager.listed_photo_paths() == [str(new)]
+    with G.app.test_request_context("/"):
+        for _ in range(5):
+            assert cache_manager.pick_file(str(photos)) == str(new)
+        # Even if every random pick lands on the tombstone, a live line is served.
+        monkeypatch.setattr(cache_manager.random, "randrange", lambda _n: 0)
+        assert cache_manager.pick_file(str(photos)) == str(new)
+
+    # A rebuild from the listed paths drops the tombstoned line for good.
+    cache_manager.build_cache(str(photos), cache_manager.listed_photo_paths())
+    assert cache_manager.count_lines_idx(all_idx) == 1
+    assert not cache_manager._WATCH_STATE["deleted"]
+
+
+def test_build_cache_keeps_watcher_events_from_during_the_rebuild(
+    tmp_path, monkeypatch
+):
+    """Photos added or deleted mid-rebuild survive the rewrite of the lists."""
+    photos = tmp_path / "photos_midbuild"
+    photos.mkdir()
+    old = photos / "20190101_old.jpg"
+    make_image(str(old))
+    setup_cache_dirs(tmp_path)
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "deleted", set())
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "added", {})
+    cache_manager.build_cache(str(photos))
+
+    new = photos / "20180505_new.jpg"
+    real_resolve = cache_manager._resolve_dates_with_cache
+
+    def resolve_then_change_tree(paths, date_cache):
+        # The walk is done; the watcher now sees one photo arrive, one go.
+        make_image(str(new))
+        cache_manager.add_cached_photo(str(new))
+        old.unlink()
+        cache_manager.remove_cached_photo(str(old))
+        return real_resolve(paths, date_cache)
+
+    monkeypatch.setattr(
+        cache_manager, "_resolve_dates_with_cache", resolve_then_change_tree
+    )
+    cache_manager.build_cache(str(photos))
+
+    assert cache_manager.listed_photo_paths() == [str(new)]
+    # Both events are in the new lists, so nothing is left pending.
+    assert not cache_manager._WATCH_STATE["deleted"]
+    assert not cache_manager._WATCH_STATE["added"]
+
+
+def test_add_cached_photo_dedupes_lines_appended_by_another_worker(
+    tmp_path, monkeypatch
+):
+    """Only newly appended bytes are read to catch another worker's append."""
+    photos = tmp_path / "photos_dedupe"
+    photos.mkdir()
+    make_image(str(photos / "20190101_old.jpg"))
+    setup_cache_dirs(tmp_path)
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "deleted", set())
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "added", {})
+    cache_manager.build_cache(str(photos))
+    all_file = os.path.join(G.CACHE_DIR, "cache_all.txt")
+    all_idx = cache_manager._index_path(all_file)
+
+    # Another worker's watcher appends the photo first.
+    new = photos / "20180505_new.jpg"
+    make_image(str(new))
+    size = os.path.getsize(all_file)
+    with open(all_file, "ab") as f:
+        f.write(f"{new}\n".encode("utf-8"))
+    with open(all_idx, "ab") as f:
+        f.write(cache_manager._INDEX_ENTRY.pack(size))
+
+    reads = []
+    real_open = open
+
+    def spy_open(file, mode="r", *args, **kwargs):
+        handle = real_open(file, mode, *args, **kwargs)
+        if file == all_file and "r" in mode:
+            real_seek = handle.seek
+            handle.seek = lambda pos, *a: reads.append(pos) or real_seek(pos, *a)
+        return handle
+
+    monkeypatch.setattr("builtins.open", spy_open)
+    assert cache_manager.add_cached_photo(str(new)) is False
+    assert reads == [size]
+    assert cache_manager.count_lines_idx(all_idx) == 2
+
+
+def test_photo_handler_lists_photos_moved_in_as_created(tmp_path, monkeypatch):
+    """Created events add complete files and walk new directories."""
+    events = pytest.importorskip("watchdog.events")
+    photos = tmp_path / "photos_created"
+    photos.mkdir()
+    make_image(str(photos / "20190101_old.jpg"))
+    setup_cache_dirs(tmp_path)
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "deleted", set())
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "added", {})
+    cache_manager.build_cache(str(photos))
+
+    moved = photos / "20180505_moved.jpg"
+    make_image(str(moved))
+    writing = photos / "20170101_writing.jpg"
+    writing.touch()
+    album = photos / "album"
+    (album / "nested").mkdir(parents=True)
+    make_image(str(album / "nested" / "20160101_deep.jpg"))
+
+    handler = cache_manager._PhotoEventHandler(str(photos))
+    handler.on_created(events.FileCreatedEvent(str(moved)))
+    handler.on_created(events.FileCreatedEvent(str(writing)))
+    handler.on_created(events.DirCreatedEvent(str(album)))
+
+    assert sorted(cache_manager.listed_photo_paths()) == sorted(
+        [
+            str(photos / "20190101_old.jpg"),
+            str(moved),
+            str(album / "nested" / "20160101_deep.jpg"),
+        ]
+    )
+
+
+def test_line_files_lock_excludes_other_processes(tmp_path):
+    """Cache-list writers in other workers should wait on the same flock."""
+    pytest.importorskip("fcntl")
+    cache_dir, _ = setup_cache_dirs(tmp_path)
+    lock_path = os.path.join(cache_dir, cache_manager._LINE_FILES_LOCK_NAME)
+    probe = (
+        "import fcntl, sys\n"
+        "with open(sys.argv[1], 'a') as f:\n"
+        "    try:\n"
+        "        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)\n"
+        "    except BlockingIOError:\n"
+        "        sys.exit(1)\n"
+    )
+
+    with cache_manager._line_files_locked():
+        held = subprocess.run([sys.executable, "-c", probe, lock_path], check=False)
+    free = subprocess.run([sys.executable, "-c", probe, lock_path], check=False)
+
+    assert held.returncode == 1
+    assert free.returncode == 0
+
+
+def test_daily_rebuild_loop_rewalks_periodically_with_watcher(monkeypatch):
+    """Watcher-mode rebuilds should still walk the tree every few passes."""
+    calls = []
+
+    class StopLoop(Exception):
+        pass
+
+    def fake_sleep(_seconds):
+        if len(calls) >= 5:
+            raise StopLoop
+
+    monkeypatch.setattr(cache_manager, "_WATCHED_REWALK_PASSES", 2)
+    monkeypatch.setattr(cache_manager, "photo_watcher_running", lambda: True)
+    monkeypatch.setattr(cache_manager, "listed_photo_paths", lambda: ["/p/a.jpg"])
+    monkeypatch.setattr(cache_manager, "seconds_until_next_rebuild", lambda: 0)
+    monkeypatch.setattr(cache_manager.time, "sleep", fake_sleep)
+    monkeypatch.setattr(
+        cache_manager, "build_cache", lambda base_dir, paths=None: calls.append(paths)
+    )
+
+    with pytest.raises(StopLoop):
+        cache_manager._daily_rebuild_loop("/p")
+
+    assert calls == [None, ["/p/a.jpg"], None, ["/p/a.jpg"], None]
+
+
+def test_start_photo_watcher_appends_new_photos(tmp_path, monkeypatch):
+    """A photo written under the root should be listed without a rebuild."""
+    pytest.importorskip("watchdog")
+    photos = tmp_path / "photos_observer"
+    photos.mkdir()
+    make_image(str(photos / "20190101_old.jpg"))
+
+    setup_cache_dirs(tmp_path)
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "observer", None)
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "deleted", set())
+    monkeypatch.setitem(cache_manager._WATCH_STATE, "added", {})
+    cache_manager.build_cache(str(photos))
+    all_idx = cache_manager._index_path(os.path.join(G.CACHE_DIR, "cache_all.txt"))
+
+    observer = cache_manager.start_photo_watcher(str(photos))
+    assert observer is not None
+    try:
+        make_image(str(photos / "20180505_new.jpg"))
+        deadline = time.monotonic() + 5
+        while cache_manager.count_lines_idx(all_idx) < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        observer.stop()
+        observer.join()
+    assert cache_manager.count_lines_idx(all_idx) == 2
@@ -3,7 +3,12 @@
 Validates instance directory creation, cache locks, and global state.
 """
 
+import logging
 import os
+from logging.handlers import QueueHandler
+
+import pytest
+from flask import session
 
 from app import globals as G
 
@@ -95,3 +100,35 @@ def test_ensure_instance_dirs_uses_configured_relative_paths(tmp_path):
         assert os.path.isdir(os.path.join(inst, "runtime-log"))
     finally:
         G.PATHS_CONFIG = original_paths
+
+
+def test_logger_hands_records_to_queue_listener(monkeypatch):
+    """Log calls should only enqueue; the listener thread writes them out."""
+    captured = []
+
+    class _CaptureHandler(logging.Handler):
+        def emit(self, record):
+            captured.append(record.getMessage())
+
+    assert any(isinstance(h, QueueHandler) for h in G.logger.handlers)
+    monkeypatch.setattr(G.log_listener, "handlers", (_CaptureHandler(),))
+
+    G.logger.info("queued %s", "record")
+    # Stopping drains the queue; restart so later tests keep logging.
+    G.log_listener.stop()
+    G.log_listener.start()
+
+    assert "queued record" in captured
+
+
+def test_filesystem_sessions_use_the_test_session_dir(session_store_dir):
+    """Session files written during tests land in the temp dir, not CACHE_DIR."""
+    interface = G.app.session_interface
+    if not hasattr(interface, "cache"):
+        pytest.skip("filesystem session backend not configured")
+
+    with G.app.test_request_context("/"):
+        session[G.SESSION_PHOTO_INDEX] = 1
+        interface.save_session(G.app, session, G.app.make_response("ok"))
+
+    assert any(session_store_dir.iterdir())
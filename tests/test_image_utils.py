@@ -4,8 +4,13 @@ Covers image resizing, compression, font caching, and overlay functionality.
 """
 
 import os
-from PIL import Image
+import subprocess
+import sys
+import threading
+import time
+from PIL import Image, ImageDraw, JpegImagePlugin
 
+from app import cache_manager
 from app import image_utils
 from app import globals as G
 
@@ -58,20 +63,48 @@ def test_resize_and_compress_creates_cache(tmp_path):
     assert data[:2] == b"\xff\xd8"
 
     # cache file should exist
-    key_hash = __import__("hashlib").md5(str(img_path).encode()).hexdigest()
+    key_hash = cache_manager.cache_key(str(img_path))
     cache_file = os.path.join(G.CACHE_DIR_PHOTO, f"{key_hash}.jpg")
     assert os.path.exists(cache_file)
     assert cache_file_path == cache_file
 
 
+def test_requests_session_is_shared_and_pooled(monkeypatch):
+    """All callers share one session with sized keep-alive pools and a UA."""
+    monkeypatch.setitem(image_utils._SESSION_CONTAINER, "session", None)
+    sessions = []
+    threads = [
+        threading.Thread(
+            target=lambda: sessions.append(image_utils.get_requests_session())
+        )
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    session_obj = sessions[0]
+    try:
+        assert all(s is session_obj for s in sessions)
+        assert session_obj.headers["User-Agent"] == image_utils._HTTP_USER_AGENT
+        adapter = session_obj.get_adapter("https://api.met.no/")
+        assert adapter._pool_maxsize == image_utils._HTTP_POOL_MAXSIZE
+        assert adapter.max_retries.total == 1
+    finally:
+        image_utils.cleanup_requests_session()
+
+
 def test_font_caching():
     """Test that fonts are cached and reused."""
     # Clear font cache first
-    image_utils._FONT_CACHE.clear()  # pylint: disable=protected-access
+    cached_font = image_utils._cached_font  # pylint: disable=protected-access
+    cached_font.cache_clear()
 
     # Load a font - min size is 12, so 1200 * 0.01 = 12
     font1 = image_utils.load_scaled_font(1200, scale=0.01)  # size = 12
-    assert 12 in image_utils._FONT_CACHE  # pylint: disable=protected-access
+    assert font1.size == 12
+    assert cached_font.cache_info().currsize == 1
 
     # Load the same size - should return cached font
     font2 = image_utils.load_scaled_font(1200, scale=0.01)
@@ -79,17 +112,18 @@ def test_font_caching():
 
     # Load a different size - 2000 * 0.01 = 20
     font3 = image_utils.load_scaled_font(2000, scale=0.01)  # size = 20
-    assert 20 in image_utils._FONT_CACHE  # pylint: disable=protected-access
+    assert font3.size == 20
     assert font3 is not font1
 
     # Verify cache has both sizes
-    assert len(image_utils._FONT_CACHE) == 2  # pylint: disable=protected-access
+    assert cached_font.cache_info().currsize == 2
 
 
 def test_font_cache_limit():
     """Test that font cache respects max size limit."""
     # Clear font cache first
-    image_utils._FONT_CACHE.clear()  # pylint: disable=protected-access
+    cached_font = image_utils._cached_font  # pylint: disable=protected-access
+    cached_font.cache_clear()
 
     # Load more fonts than the max limit
     max_cache = image_utils._MAX_FONT_CACHE  # pylint: disable=protected-access
@@ -99,8 +133,40 @@ def test_font_cache_limit():
         image_utils.load_scaled_font(height, scale=0.01)
 
     # Cache should not exceed max limit
-    # pylint: disable=protected-access
-    assert len(image_utils._FONT_CACHE) <= max_cache
+    assert cached_font.cache_info().currsize <= max_cache
+
+
+def test_apply_overlays_memoizes_text_measurement():
+    """Repeated overlay strings are measured once and match draw.textbbox."""
+    text_bbox = image_utils._text_bbox  # pylint: disable=protected-access
+    text_bbox.cache_clear()
+    image_utils._text_tile.cache_clear()  # pylint: disable=protected-access
+    overlays = {"top_left": "1st Jan 2020", "bottom_right": "1st Jan 2020"}
+
+    for _ in range(3):
+        image_utils.apply_overlays(Image.new("RGB", (800, 600)), overlays)
+
+    info = text_bbox.cache_info()
+    assert info.misses == 1
+    assert info.hits >= 5
+
+    draw = ImageDraw.Draw(Image.new("RGB", (800, 600)))
+    font = image_utils.load_scaled_font(600)
+    assert text_bbox("1st Jan 2020", font.size, draw.fontmode) == draw.textbbox(
+        (0, 0), "1st Jan 2020", font=font
+    )
+
+
+def test_paste_text_matches_draw_text_pixels():
+    """Cached glyph tiles must render exactly like drawing the text."""
+    base = Image.effect_noise((400, 120), 40).convert("RGB")
+    font = image_utils.load_scaled_font(1600)
+    drawn, pasted = base.copy(), base.copy()
+
+    image_utils.draw_text(ImageDraw.Draw(drawn), font, "gjpq 1st Jan ÅÄ", 7, 9)
+    image_utils.paste_text(pasted, "gjpq 1st Jan ÅÄ", font.size, 7, 9)
+
+    assert drawn.tobytes() == pasted.tobytes()
 
 
 def test_resize_and_compress_creates_metadata(tmp_path):
@@ -151,6 +217,262 @@ def test_resize_and_compress_cache_hit(tmp_path):
     assert mtime1 == mtime2  # File wasn't recreated
 
 
+def test_resize_and_compress_downscales_large_jpeg(tmp_path):
+    """Large JPEGs are draft-decoded and still thumbnailed to fit the limits."""
+    photos = tmp_path / "photos_large"
+    photos.mkdir()
+    img_path = photos / "large.jpg"
+    make_image(str(img_path), size=(G.MAX_WIDTH * 3, G.MAX_HEIGHT * 3))
+
+    setup_cache_dirs(tmp_path)
+
+    cache_file = image_utils.resize_and_compress(str(img_path), {}, 75)
+
+    with Image.open(cache_file) as cached:
+        assert cached.size == (G.MAX_WIDTH, G.MAX_HEIGHT)
+
+
+def test_resize_and_compress_writes_webp_variant(tmp_path):
+    """Requesting WebP writes a separate .webp cache file with its MIME type."""
+    photos = tmp_path / "photos_webp"
+    photos.mkdir()
+    img_path = photos / "webp.jpg"
+    make_image(str(img_path))
+
+    setup_cache_dirs(tmp_path)
+
+    jpeg_file = image_utils.resize_and_compress(str(img_path), {}, 75)
+    webp_file = image_utils.resize_and_compress(str(img_path), {}, 75, fmt="WEBP")
+
+    assert jpeg_file != webp_file
+    assert webp_file.endswith(".webp")
+    assert cache_manager.get_image_metadata(webp_file)[2] == "image/webp"
+    with Image.open(webp_file) as cached:
+        assert cached.format == "WEBP"
+
+
+def test_resize_and_compress_encodes_concurrent_misses_once(tmp_path, monkeypatch):
+    """Parallel misses for one image should share a single encode."""
+    photos = tmp_path / "photos_concurrent"
+    photos.mkdir()
+    img_path = photos / "shared.jpg"
+    make_image(str(img_path))
+
+    setup_cache_dirs(tmp_path)
+
+    encode = image_utils._encode_to_cache
+    calls = []
+
+    def slow_encode(*args):
+        calls.append(args[0])
+        time.sleep(0.05)
+        return encode(*args)
+
+    monkeypatch.setattr(image_utils, "_encode_to_cache", slow_encode)
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                image_utils.resize_and_compress(str(img_path), {}, 75)
+            )
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(set(results)) == 1 and len(results) == 4
+    assert not image_utils._CACHE_FILE_LOCKS
+
+
+def test_resize_and_compress_limits_concurrent_encodes(tmp_path, monkeypatch):
+    """Misses for different images should not encode more than the slot count."""
+    photos = tmp_path / "photos_slots"
+    photos.mkdir()
+    paths = []
+    for i in range(4):
+        img_path = photos / f"slot{i}.jpg"
+        make_image(str(img_path))
+        paths.append(str(img_path))
+
+    setup_cache_dirs(tmp_path)
+    monkeypatch.setattr(image_utils, "_ENCODE_SLOTS", threading.BoundedSemaphore(2))
+
+    encode = image_utils._encode_to_cache
+    state = {"active": 0, "peak": 0}
+    state_lock = threading.Lock()
+
+    def slow_encode(*args):
+        with state_lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(0.05)
+        with state_lock:
+            state["active"] -= 1
+        return encode(*args)
+
+    monkeypatch.setattr(image_utils, "_encode_to_cache", slow_encode)
+
+    threads = [
+        threading.Thread(target=image_utils.resize_and_compress, args=(path, {}, 75))
+        for path in paths
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert state["peak"] == 2
+    assert len(os.listdir(G.CACHE_DIR_PHOTO)) >= 4
+
+
+def test_resize_and_compress_drafts_rotated_jpeg_to_full_size(tmp_path):
+    """Sideways-stored JPEGs must not be drafted below the rotated fit."""
+    photos = tmp_path / "photos_rotated"
+    photos.mkdir()
+    img_path = photos / "rotated.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotate 90 CW on display
+    Image.new("RGB", (G.MAX_HEIGHT * 3, G.MAX_WIDTH * 3), (200, 100, 50)).save(
+        str(img_path), format="JPEG", exif=exif.tobytes()
+    )
+
+    setup_cache_dirs(tmp_path)
+
+    cache_file = image_utils.resize_and_compress(str(img_path), {}, 75)
+
+    with Image.open(cache_file) as cached:
+        assert cached.size == (G.MAX_WIDTH, G.MAX_HEIGHT)
+
+
+def test_resize_and_compress_drafts_mpo_jpegs(tmp_path, monkeypatch):
+    """Multi-picture camera JPEGs (MPO) should also use draft decoding."""
+    photos = tmp_path / "photos_mpo"
+    photos.mkdir()
+    img_path = photos / "camera.jpg"
+    frame = Image.new("RGB", (G.MAX_WIDTH * 3, G.MAX_HEIGHT * 3), (40, 80, 120))
+    frame.save(str(img_path), format="MPO", save_all=True, append_images=[frame])
+
+    setup_cache_dirs(tmp_path)
+
+    drafted = []
+    original_draft = JpegImagePlugin.JpegImageFile.draft
+
+    def spy_draft(self, mode, size):
+        drafted.append(self.format)
+        return original_draft(self, mode, size)
+
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, "draft", spy_draft)
+
+    cache_file = image_utils.resize_and_compress(str(img_path), {}, 75)
+
+    assert "MPO" in drafted
+    with Image.open(cache_file) as cached:
+        assert cached.size == (G.MAX_WIDTH, G.MAX_HEIGHT)
+
+
+def test_resize_and_compress_adopts_legacy_md5_cache_file(tmp_path):
+    """A JPEG cached under the old MD5 name should be renamed, not re-encoded."""
+    photos = tmp_path / "photos_legacy"
+    photos.mkdir()
+    img_path = photos / "legacy.jpg"
+    make_image(str(img_path))
+
+    _, cache_dir_photo = setup_cache_dirs(tmp_path)
+    legacy_file = os.path.join(
+        cache_dir_photo, cache_manager.legacy_cache_key(str(img_path)) + ".jpg"
+    )
+    make_image(legacy_file, size=(64, 32))
+    cache_manager.write_image_metadata(legacy_file, 64, 32)
+
+    cache_file = image_utils.resize_and_compress(str(img_path), {}, 75)
+
+    if cache_manager.xxhash is not None:
+        assert not os.path.exists(legacy_file)
+        assert cache_manager.get_image_metadata(cache_file) == (64, 32, "image/jpeg")
+    with Image.open(cache_file) as cached:
+        assert cached.size == (64, 32)
+
+
+def test_resize_and_compress_converts_only_non_rgb_images(tmp_path, monkeypatch):
+    """RGB sources skip convert("RGB"); RGBA sources are flattened onto black."""
+    photos = tmp_path / "photos_modes"
+    photos.mkdir()
+    rgb_path = photos / "rgb.jpg"
+    make_image(str(rgb_path))
+    rgba_path = photos / "rgba.png"
+    Image.new("RGBA", (60, 40), (10, 20, 30, 128)).save(str(rgba_path))
+
+    setup_cache_dirs(tmp_path)
+
+    converted = []
+    original_convert = Image.Image.convert
+
+    def spy_convert(self, mode=None, *args, **kwargs):
+        converted.append((self.mode, mode))
+        return original_convert(self, mode, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "convert", spy_convert)
+
+    image_utils.resize_and_compress(str(rgb_path), {}, 75)
+    assert ("RGB", "RGB") not in converted
+
+    rgba_cache = image_utils.resize_and_compress(str(rgba_path), {}, 75)
+    assert ("RGBA", "RGB") not in converted
+    with Image.open(rgba_cache) as cached:
+        assert cached.mode == "RGB"
+        # Half-transparent (10, 20, 30) composited onto black.
+        r, g, b = cached.getpixel((30, 20))
+        assert abs(r - 5) <= 2 and abs(g - 10) <= 2 and abs(b - 15) <= 2
+
+
+def test_pillow_heif_is_loaded_only_for_heic_files(tmp_path):
+    """Importing the app must not load pillow_heif; a HEIC resize registers it."""
+    code = "import sys, app.routes; print('pillow_heif' in sys.modules)"
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip().endswith("False")
+
+    photos = tmp_path / "photos_heic"
+    photos.mkdir()
+    heic_path = photos / "pic.heic"
+    assert cache_manager.ensure_heif_opener(str(heic_path))
+    Image.new("RGB", (60, 40), (10, 20, 30)).save(str(heic_path), format="HEIF")
+
+    setup_cache_dirs(tmp_path)
+    cache_file = image_utils.resize_and_compress(str(heic_path), {}, 75)
+    with Image.open(cache_file) as cached:
+        assert cached.format == "JPEG"
+        assert cached.size == (60, 40)
+
+
+def test_resize_and_compress_uses_progressive_only_for_large_jpegs(tmp_path):
+    """Large slides are saved progressive; small ones as optimized baseline."""
+    photos = tmp_path / "photos_progressive"
+    photos.mkdir()
+    large = photos / "large.png"
+    small = photos / "small.png"
+    Image.new("RGB", (G.MAX_WIDTH, G.MAX_HEIGHT), (1, 2, 3)).save(str(large))
+    Image.new("RGB", (300, 200), (1, 2, 3)).save(str(small))
+
+    setup_cache_dirs(tmp_path)
+    with Image.open(image_utils.resize_and_compress(str(large), {}, 75)) as cached:
+        assert cached.info.get("progressive")
+        assert JpegImagePlugin.get_sampling(cached) == 2
+    with Image.open(image_utils.resize_and_compress(str(small), {}, 75)) as cached:
+        assert not cached.info.get("progressive")
+        assert JpegImagePlugin.get_sampling(cached) == 2
+
+
 def test_apply_overlays_all_corners():
     """Test that overlays can be applied to all four corners."""
     img = Image.new("RGB", (800, 600), (100, 100, 100))
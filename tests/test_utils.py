@@ -98,6 +98,7 @@ def test_initialize_app_state_sets_photo_root(monkeypatch):
     U.initialize_app_state()
 
     assert U.G.PHOTO_ROOT == "/photos"
+    assert any("JPEG library" in msg for msg, _ in logger_stub.info_calls)
 
 
 def test_wsgi_import_initializes_photo_root(monkeypatch):
@@ -0,0 +1,33 @@
+"""Tests for weather mapping and the in-process weather cache."""
+
+from app import weather_utils
+
+
+def test_weather_cache_expires_and_stays_bounded(monkeypatch):
+    """Entries expire after the TTL and the oldest go once the cache is full."""
+    clock = [1000.0]
+    monkeypatch.setattr(weather_utils.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(weather_utils, "_weather_cache", weather_utils.OrderedDict())
+    monkeypatch.setattr(weather_utils, "_MAX_CACHE_ENTRIES", 2)
+
+    weather_utils.set_cached_weather("1", "2", {"temp": 1})
+    assert weather_utils.get_cached_weather("1", "2") == {"temp": 1}
+
+    clock[0] += weather_utils._CACHE_TTL
+    assert weather_utils.get_cached_weather("1", "2") is None
+    assert not weather_utils._weather_cache
+
+    for lat in ("a", "b", "c"):
+        weather_utils.set_cached_weather(lat, "0", {"temp": lat})
+    assert weather_utils.get_cached_weather("a", "0") is None
+    assert weather_utils.get_cached_weather("c", "0") == {"temp": "c"}
+    assert len(weather_utils._weather_cache) == 2
+
+
+def test_map_openmeteo_code_matches_code_map():
+    """The tuple lookup agrees with OPENMETEO_CODE_MAP, including defaults."""
+    for code in range(-1, 101):
+        expected = weather_utils.OPENMETEO_CODE_MAP.get(code, "cloudy")
+        assert weather_utils.map_openmeteo_code(code) == expected
+    assert weather_utils.map_openmeteo_code(61.0) == "rain"
+    assert weather_utils.map_openmeteo_code(None) == "cloudy"